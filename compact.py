@@ -0,0 +1,81 @@
+ORDER_FIELDS = [
+    'timestamp',
+    'price',
+    'volume',
+    'is_bid',
+    'pcode',
+    'traded_volume',
+    'remaining_volume',
+    'order_id',
+    'asset_name',
+    'seq',
+]
+'''the fields of an order, in the order they appear in an encoded order. seq is only included in the order sent
+with a confirm_enter or confirm_cancel message'''
+
+
+class CompactEncoder():
+    '''this class encodes messages for a single group in the compact format used when the group's compact_messages
+    property is set
+
+    in the compact format, orders are sent as arrays of their fields in the order given by ORDER_FIELDS instead of as dicts,
+    timestamps are sent as integer milliseconds, and participant codes and asset names are sent as indices into lists of
+    every participant code and asset name in the group. trades are sent as [timestamp, asset, taking order, [making orders], seq].
+    the field names, participant codes and asset names make up the schema, which is sent once with the initial page state
+    so the frontend can decode these messages.
+    '''
+
+    def __init__(self, asset_names, pcodes):
+        self.asset_names = list(asset_names)
+        '''every asset name in the group. assets are sent as indices into this list'''
+        self.pcodes = list(pcodes)
+        '''every participant code in the group. participant codes are sent as indices into this list'''
+        self._asset_ids = {name: i for i, name in enumerate(self.asset_names)}
+        self._pcode_ids = {pcode: i for i, pcode in enumerate(self.pcodes)}
+
+    def schema(self):
+        '''get the schema the frontend needs to decode messages from this encoder'''
+        return {
+            'order_fields': ORDER_FIELDS,
+            'asset_names': self.asset_names,
+            'pcodes': self.pcodes,
+        }
+
+    def encode_message(self, message):
+        '''encode a {'channel': ..., 'payload': ...} message. messages on channels with no compact format are returned as-is'''
+        channel = message['channel']
+        if channel in ('confirm_enter', 'confirm_cancel'):
+            return {'channel': channel, 'payload': self.encode_order(message['payload'])}
+        if channel == 'confirm_trade':
+            return {'channel': channel, 'payload': self.encode_trade(message['payload'])}
+        return message
+
+    def encode_order(self, order_dict):
+        '''encode a dict from Order.as_dict'''
+        encoded = [
+            round(order_dict['timestamp'] * 1000),
+            order_dict['price'],
+            order_dict['volume'],
+            order_dict['is_bid'],
+            # participant codes or asset names this encoder doesn't know about (e.g. from bots) are sent as-is
+            self._pcode_ids.get(order_dict['pcode'], order_dict['pcode']),
+            order_dict['traded_volume'],
+            order_dict['remaining_volume'],
+            order_dict['order_id'],
+            self._asset_ids.get(order_dict['asset_name'], order_dict['asset_name']),
+        ]
+        if 'seq' in order_dict:
+            encoded.append(order_dict['seq'])
+        return encoded
+
+    def encode_trade(self, trade_dict):
+        '''encode a dict from Trade.as_dict'''
+        encoded = [
+            round(trade_dict['timestamp'] * 1000),
+            self._asset_ids.get(trade_dict['asset_name'], trade_dict['asset_name']),
+            self.encode_order(trade_dict['taking_order']),
+            [self.encode_order(o) for o in trade_dict['making_orders']],
+        ]
+        if 'seq' in trade_dict:
+            encoded.append(trade_dict['seq'])
+        return encoded
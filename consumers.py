@@ -0,0 +1,40 @@
+from channels.generic.websocket import JsonWebsocketConsumer
+from channels.layers import get_channel_layer
+from asgiref.sync import async_to_sync
+
+
+def participant_group_name(pcode):
+    '''get the name of the channel layer group a participant's private message socket is subscribed to'''
+    return f'otree_markets-participant-{pcode}'
+
+def send_to_participant(pcode, channel, payload):
+    '''send a message to a single participant's private message socket
+
+    unlike RedwoodGroup.send, this doesn't broadcast to the rest of the group or save an event to the database'''
+    async_to_sync(get_channel_layer().group_send)(
+        participant_group_name(pcode),
+        {
+            'type': 'otree_markets.send_to_participant',
+            'text': {
+                'channel': channel,
+                'payload': payload,
+            },
+        }
+    )
+
+
+class ParticipantConsumer(JsonWebsocketConsumer):
+    '''this consumer handles the websocket each trader uses to receive messages meant only for them, like errors'''
+
+    url_pattern = r'^otree_markets/participant/(?P<participant_code>[a-zA-Z0-9_-]+)/$'
+
+    def connect(self):
+        self.accept()
+        self.group_name = participant_group_name(self.scope['url_route']['kwargs']['participant_code'])
+        async_to_sync(self.channel_layer.group_add)(self.group_name, self.channel_name)
+
+    def disconnect(self, close_code):
+        async_to_sync(self.channel_layer.group_discard)(self.group_name, self.channel_name)
+
+    def otree_markets_send_to_participant(self, event):
+        self.send_json(event['text'])
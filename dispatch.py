@@ -0,0 +1,177 @@
+from django.db import close_old_connections
+from collections import deque
+from itertools import islice
+import threading
+import queue
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+class ShardedDispatcher():
+    '''this class runs tasks on a fixed pool of worker threads, where every task submitted with the same key
+    runs on the same worker thread in the order it was submitted.
+
+    oTree Markets uses this to process each exchange's events strictly in order, while events for different
+    exchanges (different assets or groups) are processed at the same time on different workers. each worker
+    thread has its own database connection.
+    '''
+
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        '''the number of worker threads'''
+        self._queues = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        '''start the worker threads if they aren't running yet'''
+        with self._start_lock:
+            if self._queues is not None:
+                return
+            queues = [queue.Queue() for _ in range(self.num_workers)]
+            for i, q in enumerate(queues):
+                thread = threading.Thread(target=self._run, args=(q,), name=f'otree_markets-worker-{i}', daemon=True)
+                thread.start()
+            self._queues = queues
+
+    def submit(self, key, func, *args):
+        '''queue func(*args) to be run on the worker responsible for `key`'''
+        if self._queues is None:
+            self._start()
+        self._queues[hash(key) % self.num_workers].put((func, args))
+
+    def join(self):
+        '''block until every task submitted so far has finished'''
+        if self._queues is None:
+            return
+        for q in self._queues:
+            q.join()
+
+    def _run(self, q):
+        while True:
+            func, args = q.get()
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('error processing sharded market event')
+            finally:
+                close_old_connections()
+                q.task_done()
+
+
+_dispatchers = {}
+_dispatchers_lock = threading.Lock()
+
+def get_dispatcher(num_workers):
+    '''get the process-wide dispatcher with `num_workers` worker threads, creating it if necessary'''
+    with _dispatchers_lock:
+        if num_workers not in _dispatchers:
+            _dispatchers[num_workers] = ShardedDispatcher(num_workers)
+        return _dispatchers[num_workers]
+
+
+class MessageOutbox():
+    '''this class collects outgoing messages for a single group and sends them together as one 'batch' message
+    once `window` seconds have passed since the first message was added.
+
+    messages are always sent in the order they were added, even if one batch is still being sent when the
+    next one is due.
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        '''how long to hold messages for, in seconds'''
+        self._messages = []
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def add(self, group, messages):
+        '''add messages to be sent to `group`. they're sent with group._send_batch when the window is up'''
+        with self._lock:
+            start_timer = not self._messages
+            self._messages.extend(messages)
+        if start_timer:
+            timer = threading.Timer(self.window, self._flush, args=(group,))
+            timer.daemon = True
+            timer.start()
+
+    def _flush(self, group):
+        with self._send_lock:
+            with self._lock:
+                messages, self._messages = self._messages, []
+            try:
+                if messages:
+                    group._send_batch(messages)
+            except Exception:
+                logger.exception('error sending batched market messages')
+            finally:
+                close_old_connections()
+
+
+_outboxes = {}
+_outboxes_lock = threading.Lock()
+
+def get_outbox(key, window):
+    '''get the process-wide outbox for the group identified by `key`, creating it if necessary'''
+    with _outboxes_lock:
+        if key not in _outboxes:
+            _outboxes[key] = MessageOutbox(window)
+        return _outboxes[key]
+
+def discard_outbox(key):
+    '''forget the outbox for the group identified by `key`. messages already added to it are still sent'''
+    with _outboxes_lock:
+        _outboxes.pop(key, None)
+
+
+STREAM_EPOCH = uuid.uuid4().hex
+'''a random id for this server process's message streams
+
+sequence numbers start over whenever the server restarts, so clients send this back with the last sequence number they
+saw to make sure it refers to the same stream'''
+
+class EventRing():
+    '''this class numbers the messages sent for a single exchange and keeps the most recent `size` of them, so a client
+    that missed some messages can be sent just the ones it missed.
+    '''
+
+    def __init__(self, size):
+        self.last_seq = 0
+        '''the sequence number of the most recent message, or 0 if no messages have been sent'''
+        self._messages = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def append(self, message):
+        '''give a {'channel': ..., 'payload': ...} message the next sequence number and remember it.
+        the sequence number is stored in the seq field of the message's payload'''
+        with self._lock:
+            self.last_seq += 1
+            message['payload']['seq'] = self.last_seq
+            self._messages.append(message)
+
+    def since(self, seq):
+        '''get a list of every message after sequence number `seq`, or None if some of them aren't kept anymore'''
+        with self._lock:
+            if seq > self.last_seq:
+                return None
+            first_seq = self.last_seq - len(self._messages) + 1
+            if seq + 1 < first_seq:
+                return None
+            return list(islice(self._messages, seq + 1 - first_seq, None))
+
+
+_event_rings = {}
+_event_rings_lock = threading.Lock()
+
+def get_event_ring(key, size):
+    '''get the process-wide event ring for the exchange identified by `key`, creating it if necessary'''
+    with _event_rings_lock:
+        if key not in _event_rings:
+            _event_rings[key] = EventRing(size)
+        return _event_rings[key]
+
+def discard_event_ring(key):
+    '''forget the event ring for the exchange identified by `key`'''
+    with _event_rings_lock:
+        _event_rings.pop(key, None)
@@ -6,6 +6,24 @@ from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericRelation
 from django.utils import timezone
 
+_exchange_asset_names = {}
+'''cache of exchanges' asset names, keyed by (content type id, exchange id)
+
+an exchange's asset name never changes, so once an entry is in here it's always correct
+'''
+
+def register_exchange(exchange):
+    '''add an exchange to the asset name cache, so that orders and trades in it can be serialized without loading it'''
+    _exchange_asset_names[(ContentType.objects.get_for_model(exchange).id, exchange.pk)] = exchange.asset_name
+
+def _get_exchange_asset_name(obj):
+    '''get the asset name of the exchange an order, trade or fill belongs to, loading the exchange only if it isn't cached'''
+    key = (obj.content_type_id, obj.object_id)
+    asset_name = _exchange_asset_names.get(key)
+    if asset_name is None:
+        asset_name = _exchange_asset_names[key] = obj.exchange.asset_name
+    return asset_name
+
 class BaseExchange(models.Model):
     '''this model is the base model which all oTree Markets exchange implementations should inherit from
     
@@ -35,6 +53,8 @@ class BaseExchange(models.Model):
     '''a queryset of all the orders associated with this exchange'''
     trades = GenericRelation('Trade')
     '''a queryset of all the trades associated with this exchange'''
+    fills = GenericRelation('Fill')
+    '''a queryset of all the fills associated with this exchange'''
 
     def enter_order(self, price, volume, is_bid, pcode):
         '''enter a regular bid or ask into the exchange'''
@@ -56,16 +76,39 @@ class BaseExchange(models.Model):
         '''directly trade with the order with id `accepted_order_id`'''
         pass
 
+    def enter_orders(self, orders):
+        '''enter several regular bids or asks into the exchange at once
+
+        `orders` is a list of dicts with the keys 'price', 'volume', 'is_bid' and 'pcode'. by default this just enters
+        each order in turn; exchanges can override it to process the whole batch more efficiently'''
+        for order in orders:
+            self.enter_order(order['price'], order['volume'], order['is_bid'], order['pcode'])
+
+    def cancel_orders(self, order_ids):
+        '''cancel several already entered orders at once'''
+        for order_id in order_ids:
+            self.cancel_order(order_id)
+
+    def cancel_all(self, pcode, side=None):
+        '''cancel all of a player's active orders at once. if side is 'bid' or 'ask', only cancel that player's bids or asks'''
+        qset = self.orders.filter(pcode=pcode, status=OrderStatusEnum.ACTIVE)
+        if side is not None:
+            qset = qset.filter(is_bid=(side == 'bid'))
+        self.cancel_orders(list(qset.values_list('id', flat=True)))
+
 
 class OrderStatusEnum(enum.IntEnum):
     ACTIVE         = enum.auto()
-    '''this order is currently on the market, available to be traded with'''
+    '''this order is currently on the market, available to be traded with
+
+    an active order may already have been partially filled, in which case its traded_volume is nonzero
+    '''
     CANCELED       = enum.auto()
     '''this order was canceled'''
     TRADED_TAKER   = enum.auto()
-    '''this order was part of a regular trade where it was the taker'''
+    '''this order was completely filled by a regular trade where it was the taker'''
     TRADED_MAKER   = enum.auto()
-    '''this order was part of a regular trade where it was the maker'''
+    '''this order was completely filled by a regular trade where it was the maker'''
     ACCEPTED_TAKER = enum.auto()
     '''this order was part of an immediate accept trade where it was the taker'''
     ACCEPTED_MAKER = enum.auto()
@@ -97,18 +140,17 @@ class Order(models.Model):
     price     = models.IntegerField()
     '''this order's price'''
     volume    = models.IntegerField()
-    '''this order's volume'''
+    '''this order's volume when it was submitted'''
     is_bid    = models.BooleanField()
     '''true if this is a bid, false if it's an ask'''
     pcode     = models.CharField(max_length=32)
     '''the participant code for the player who submitted this order'''
     traded_volume = models.IntegerField(null=True)
-    '''the portion of this trade's volume which was actually traded
+    '''the portion of this order's volume which has been traded so far
 
-    this is used for partially filled orders
+    null if no part of this order has traded yet. partially filled orders stay on the market with their
+    remaining volume, so this can be nonzero for an active order
     '''
-    making_trade  = models.ForeignKey('Trade', null=True, related_name='making_orders', on_delete=models.CASCADE)
-    '''if this field is not null, then it references a trade where this order was in the market when the trade occurred'''
     time_inactive = models.DateTimeField(null=True)
     '''the time that this order's status changed from active to something else
     
@@ -123,10 +165,23 @@ class Order(models.Model):
     '''the exchange this order is associated with'''
 
     # Order will have a related name 'taking_trade' from Trade if this order immediately transacted when it was entered
-    # if an order has transacted, then either making_trade or taking_trade will be set
+    # Order will also have a related name 'making_trades' from Trade, a set of every trade this order was filled by while
+    # it was in the market. 'fills' holds the amount traded in each of those trades
 
-    def as_dict(self):
-        '''returns a dict representation of this order'''
+    @property
+    def asset_name(self):
+        '''the name of the asset traded in this order's exchange'''
+        return _get_exchange_asset_name(self)
+
+    @property
+    def remaining_volume(self):
+        '''the portion of this order's volume which hasn't been traded'''
+        return self.volume - (self.traded_volume or 0)
+
+    def as_dict(self, asset_name=None):
+        '''returns a dict representation of this order
+
+        if asset_name is given it's used instead of looking up this order's exchange'''
         return {
             'timestamp': self.timestamp.timestamp(),
             'price': self.price,
@@ -134,8 +189,9 @@ class Order(models.Model):
             'is_bid': self.is_bid,
             'pcode': self.pcode,
             'traded_volume': self.traded_volume,
+            'remaining_volume': self.remaining_volume,
             'order_id': self.id,
-            'asset_name': self.exchange.asset_name,
+            'asset_name': asset_name if asset_name is not None else self.asset_name,
         }
 
     def __str__(self):
@@ -159,6 +215,8 @@ class Trade(models.Model):
     '''the time this trade occured'''
     taking_order = models.OneToOneField('Order', related_name='taking_trade', on_delete=models.CASCADE)
     '''the order that triggered this trade'''
+    making_orders = models.ManyToManyField('Order', through='Fill', through_fields=('trade', 'making_order'), related_name='making_trades')
+    '''all the orders involved in this trade which were already in the market when the trade occurred'''
 
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     '''used to relate this trade to an arbitrary exchange'''
@@ -167,15 +225,23 @@ class Trade(models.Model):
     exchange = GenericForeignKey('content_type', 'object_id')
     '''the exchange this trade occurred in'''
 
-    # trades have a related name 'making_orders' from Order. this is a set of all the orders involved in this trade
-    # which were already in the market when the trade occurred
+    # trades have a related name 'fills' from Fill. this holds the price and volume traded with each of the making orders
+
+    @property
+    def asset_name(self):
+        '''the name of the asset traded in this trade's exchange'''
+        return _get_exchange_asset_name(self)
 
     def as_dict(self):
+        '''returns a dict representation of this trade
+
+        this reads the trade's fills and their making orders, so prefetch 'fills__making_order' when serializing many trades'''
+        asset_name = self.asset_name
         return {
             'timestamp': self.timestamp.timestamp(),
-            'asset_name': self.exchange.asset_name,
-            'taking_order': self.taking_order.as_dict(),
-            'making_orders': [o.as_dict() for o in self.making_orders.prefetch_related('exchange').all()],
+            'asset_name': asset_name,
+            'taking_order': self.taking_order.as_dict(asset_name),
+            'making_orders': [f.making_order_dict() for f in self.fills.all()],
         }
 
     def __str__(self):
@@ -187,4 +253,47 @@ class Trade(models.Model):
         ).format(
             self.taking_order,
             '\n'.join(' ' + str(o) for o in self.making_orders.all())
-        )
\ No newline at end of file
+        )
+
+
+class Fill(models.Model):
+    '''this model records the part of a single making order which was traded in a single trade
+
+    fills are written once when a trade happens and carry their own price, volume and asset, so trade history
+    and volume statistics can be read from this table alone without walking each trade's orders
+    '''
+
+    class Meta:
+        app_label = 'otree_markets'
+        ordering = ['timestamp', 'id']
+
+    timestamp = models.DateTimeField(default=timezone.now)
+    '''the time the trade this fill was part of occurred'''
+    trade = models.ForeignKey('Trade', related_name='fills', on_delete=models.CASCADE)
+    '''the trade this fill was part of'''
+    making_order = models.ForeignKey('Order', related_name='fills', on_delete=models.CASCADE)
+    '''the order which was in the market and got (partially) filled'''
+    taking_order = models.ForeignKey('Order', related_name='taking_fills', on_delete=models.CASCADE)
+    '''the order that triggered the trade this fill was part of'''
+    price = models.IntegerField()
+    '''the price this fill traded at. this is always the making order's price'''
+    volume = models.IntegerField()
+    '''the volume of the making order which was traded'''
+    asset_name = models.CharField(max_length=32)
+    '''the name of the asset traded'''
+
+    content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    '''used to relate this fill to an arbitrary exchange'''
+    object_id = models.PositiveIntegerField()
+    '''primary key of this fill's related exchange'''
+    exchange = GenericForeignKey('content_type', 'object_id')
+    '''the exchange this fill occurred in'''
+
+    def making_order_dict(self):
+        '''returns a dict representation of the making order where traded_volume is the volume traded in this fill'''
+        order_dict = self.making_order.as_dict(self.asset_name)
+        order_dict['traded_volume'] = self.volume
+        return order_dict
+
+    def __str__(self):
+        return '{} of {}'.format(self.volume, self.making_order)
\ No newline at end of file
@@ -1,17 +1,58 @@
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Sum
+from django.db.models.functions import Coalesce
 from itertools import chain
+from contextlib import contextmanager
 from django.utils import timezone
 import logging
+import copy
 
-from .base import BaseExchange, Order, Trade, OrderStatusEnum
+from .base import BaseExchange, Order, Trade, Fill, OrderStatusEnum
+from .order_book import OrderBook, Depth
 
 logger = logging.getLogger(__name__)
 
+_memory_books = {}
+'''in-memory order books for exchanges running with Group.memory_order_book set, keyed by (model label, exchange id)
+
+these live for the lifetime of the server process and are rebuilt from the database the first time
+an exchange is used after a restart.
+'''
+
+_order_indexes = {}
+'''indexes of each exchange's active orders, keyed by (model label, exchange id)
+
+each value is a dict mapping order ids to the Order objects for every active order in that exchange. when the exchange
+is using an in-memory book, the book holds these same Order objects. like the in-memory books, this assumes all of a
+group's messages are handled by a single server process.
+'''
+
+_quotes = {}
+'''cached best bid and ask of each exchange, keyed by (model label, exchange id)
+
+each value is a dict which can have the keys 'bid' and 'ask'. a side's value is either None if that side of the book
+is empty, or a dict with the price, total volume and order id of the best order on that side. a side is missing
+when it has to be recomputed from the book. like the in-memory books, this assumes all of a group's messages are
+handled by a single server process.
+'''
+
+_depths = {}
+'''aggregated depth of each exchange's book, keyed by (model label, exchange id)
+
+each value is a Depth holding the total remaining volume at each price. like the in-memory books, this assumes all of a
+group's messages are handled by a single server process.
+'''
+
 class CDAExchange(BaseExchange):
     '''this model represents a continuous double auction exchange'''
 
-    # CDAExchange has additional fields 'trades' and 'orders'
-    # these are related names from ForeignKey fields on Trade and Order
+    # CDAExchange has additional fields 'trades', 'orders' and 'fills'
+    # these are related names from ForeignKey fields on Trade, Order and Fill
+
+    _pending_confirmations = None
+    '''(channel, obj) confirmations waiting for the current matching transaction to commit, or None outside of one'''
+    _depth_changes = None
+    '''set of (is_bid, price) for each price level changed in the current matching transaction, or None outside of one'''
     
     def _get_bids_qset(self):
         '''get a queryset of all active bids in this exchange, sorted by descending price then ascending timestamp
@@ -29,12 +70,187 @@ class CDAExchange(BaseExchange):
         return (self.orders.filter(is_bid=False, status=OrderStatusEnum.ACTIVE)
                            .order_by('price', 'timestamp'))
     
+    def _uses_memory_book(self):
+        '''returns true if this exchange matches orders against an in-memory book instead of querying the database'''
+        return getattr(self.group, 'memory_order_book', False)
+
+    def _cache_key(self):
+        '''the key used for this exchange in the process-wide caches in this module'''
+        return (self._meta.label, self.pk)
+
+    def _get_order_index(self):
+        '''get the index of this exchange's active orders by id, loading it from the database if it doesn't exist yet'''
+        key = self._cache_key()
+        index = _order_indexes.get(key)
+        if index is None:
+            index = {o.id: o for o in self.orders.filter(status=OrderStatusEnum.ACTIVE).order_by('timestamp')}
+            _order_indexes[key] = index
+        return index
+
+    def _get_memory_book(self):
+        '''get the in-memory order book for this exchange, building it from the active orders in the database if it doesn't exist yet'''
+        key = self._cache_key()
+        book = _memory_books.get(key)
+        if book is None:
+            book = OrderBook(self._get_order_index().values())
+            _memory_books[key] = book
+        return book
+
+    def _book_insert(self, order):
+        '''record that an order has become active, adding it to the in-memory book, order index, cached quote and depth'''
+        if self._uses_memory_book():
+            self._get_memory_book().insert(order)
+
+        index = _order_indexes.get(self._cache_key())
+        if index is not None:
+            index[order.id] = order
+
+        self._depth_add(order.is_bid, order.price, order.remaining_volume)
+
+        quote = _quotes.get(self._cache_key())
+        side = 'bid' if order.is_bid else 'ask'
+        if quote is None or side not in quote:
+            return
+        best = quote[side]
+        if best is None or (order.price > best['price'] if order.is_bid else order.price < best['price']):
+            quote[side] = {'price': order.price, 'volume': order.remaining_volume, 'order_id': order.id}
+        elif order.price == best['price']:
+            best['volume'] += order.remaining_volume
+
+    def _book_fill(self, order, volume):
+        '''record that `volume` of an active order has been filled. if that fills the whole order, _book_remove should be
+        called afterwards'''
+        index = _order_indexes.get(self._cache_key())
+        if index is not None:
+            index[order.id] = order
+        self._depth_add(order.is_bid, order.price, -volume)
+
+    def _book_remove(self, order):
+        '''record that an order is no longer active, removing it from the in-memory book, order index, cached quote and depth'''
+        if self._uses_memory_book():
+            self._get_memory_book().remove(order)
+
+        index = _order_indexes.get(self._cache_key())
+        if index is not None:
+            index.pop(order.id, None)
+
+        # filled orders have no remaining volume here, their volume was already taken out by _book_fill
+        self._depth_add(order.is_bid, order.price, -order.remaining_volume)
+
+        quote = _quotes.get(self._cache_key())
+        side = 'bid' if order.is_bid else 'ask'
+        if quote and quote.get(side) and quote[side]['price'] == order.price:
+            self._invalidate_quote(order.is_bid)
+
+    def _invalidate_quote(self, is_bid):
+        '''mark one side of the cached quote as needing to be recomputed'''
+        quote = _quotes.get(self._cache_key())
+        if quote is not None:
+            quote.pop('bid' if is_bid else 'ask', None)
+
+    def _get_quote(self, is_bid):
+        '''get the cached best price, volume and order id for one side of the book, recomputing it if necessary
+
+        returns None if that side of the book is empty'''
+        quote = _quotes.setdefault(self._cache_key(), {})
+        side = 'bid' if is_bid else 'ask'
+        if side in quote:
+            return quote[side]
+
+        if self._uses_memory_book():
+            book = self._get_memory_book()
+            level = (book.bids if is_bid else book.asks).best_level()
+            if level:
+                best = level[0]
+                volume = sum(o.remaining_volume for o in level)
+            else:
+                best = None
+        else:
+            qset = self._get_bids_qset() if is_bid else self._get_asks_qset()
+            best = qset.first()
+            if best:
+                volume = (qset.filter(price=best.price)
+                              .aggregate(volume=Sum(F('volume') - Coalesce('traded_volume', 0)))['volume'])
+
+        quote[side] = {'price': best.price, 'volume': volume, 'order_id': best.id} if best else None
+        return quote[side]
+
+    def get_bbo(self):
+        '''get the best bid and offer in this exchange
+
+        returns a dict with the keys 'bid' and 'ask'. each is either None if that side of the book is empty, or a dict
+        with the keys 'price', 'volume' and 'order_id' describing the best price, the total volume at that price and the
+        id of the order at that price with the highest priority. this is cached and updated as orders are entered,
+        filled and canceled, so it's cheap to call often.
+        '''
+        return {
+            'bid': self._get_quote(is_bid=True),
+            'ask': self._get_quote(is_bid=False),
+        }
+
+    def _get_depth(self):
+        '''get the aggregated depth of this exchange's book, building it from the active orders if it doesn't exist yet'''
+        key = self._cache_key()
+        depth = _depths.get(key)
+        if depth is None:
+            depth = _depths[key] = Depth(self._get_order_index().values())
+        return depth
+
+    def _depth_add(self, is_bid, price, volume):
+        '''add `volume` to the cached depth at `price` on one side of the book, and remember that the level changed'''
+        if volume == 0:
+            return
+        depth = _depths.get(self._cache_key())
+        if depth is not None:
+            depth.add(is_bid, price, volume)
+        if self._depth_changes is not None:
+            self._depth_changes.add((is_bid, price))
+
+    def get_depth(self, levels=None):
+        '''get the aggregated depth of this exchange's book
+
+        returns a dict with the keys 'bids' and 'asks'. each is a list of [price, volume] pairs for the best `levels`
+        prices on that side in priority order (or every price if levels is None), where volume is the total remaining
+        volume of all the active orders at that price. like get_bbo, this is cached and updated as orders are entered,
+        filled and canceled.
+        '''
+        depth = self._get_depth()
+        return {
+            'bids': depth.bids.levels(levels),
+            'asks': depth.asks.levels(levels),
+        }
+
+    def _get_depth_update(self, changes):
+        '''get the current volume of the price levels in `changes`, a set of (is_bid, price), in the same format as get_depth.
+        levels which no longer have any volume have a volume of 0'''
+        depth = self._get_depth()
+        return {
+            'bids': [[price, depth.bids.volume(price)] for is_bid, price in sorted(changes, reverse=True) if is_bid],
+            'asks': [[price, depth.asks.volume(price)] for is_bid, price in sorted(changes) if not is_bid],
+        }
+
+    def _iter_bids(self):
+        '''iterate through the active bids in this exchange in priority order'''
+        if self._uses_memory_book():
+            return iter(self._get_memory_book().bids)
+        return iter(self._get_bids_qset())
+
+    def _iter_asks(self):
+        '''iterate through the active asks in this exchange in priority order'''
+        if self._uses_memory_book():
+            return iter(self._get_memory_book().asks)
+        return iter(self._get_asks_qset())
+
     def _get_best_bid(self):
         '''get the best bid in this exchange'''
+        if self._uses_memory_book():
+            return self._get_memory_book().bids.best()
         return self._get_bids_qset().first()
     
     def _get_best_ask(self):
         '''get the best ask in this exchange'''
+        if self._uses_memory_book():
+            return self._get_memory_book().asks.best()
         return self._get_asks_qset().first()
     
     def _get_trades_qset(self):
@@ -43,27 +259,98 @@ class CDAExchange(BaseExchange):
         use descending timestamp because knowledge of recent trades is more useful than that of older trades
         '''
         return (self.trades.order_by('-timestamp')
-                           .prefetch_related('taking_order', 'making_orders'))
+                           .prefetch_related('taking_order', 'fills__making_order'))
     
+    def _get_fills_qset(self):
+        '''get a queryset of all fills that have occurred in this exchange, ordered by descending timestamp'''
+        return self.fills.order_by('-timestamp', '-id')
+
+    def get_traded_volume(self, since=None):
+        '''get the total volume traded in this exchange, optionally only counting trades after the datetime `since`'''
+        fills = self.fills.all() if since is None else self.fills.filter(timestamp__gt=since)
+        return fills.aggregate(volume=Sum('volume'))['volume'] or 0
+
+    def get_vwap(self, since=None):
+        '''get the volume-weighted average price of all trades in this exchange, optionally only counting trades after
+        the datetime `since`. returns None if nothing has traded'''
+        fills = self.fills.all() if since is None else self.fills.filter(timestamp__gt=since)
+        totals = fills.aggregate(volume=Sum('volume'), value=Sum(F('price') * F('volume')))
+        if not totals['volume']:
+            return None
+        return totals['value'] / totals['volume']
+
     def _get_order(self, order_id):
         try:
             return self.orders.get(id=order_id)
         except Order.DoesNotExist as e:
             raise ValueError(f'order with id {order_id} not found') from e
 
+    def _get_active_order(self, order_id):
+        '''get an active order from the order index without querying the database. returns None if there's no active order with this id'''
+        return self._get_order_index().get(order_id)
+
+    def _discard_cached_state(self):
+        '''throw away this exchange's in-memory book, order index, cached quote and depth so that they're rebuilt from the database the next time they're used'''
+        _memory_books.pop(self._cache_key(), None)
+        _order_indexes.pop(self._cache_key(), None)
+        _quotes.pop(self._cache_key(), None)
+        _depths.pop(self._cache_key(), None)
+
+    @contextmanager
+    def _matching_transaction(self, batch=False):
+        '''run a block of exchange operations in a single database transaction
+
+        confirmations sent to the group inside this block are held until the transaction has committed, so the
+        frontend never hears about rows that could still be rolled back. if batch is true, they're all sent in a single
+        batch message instead of one at a time. if the block fails, the cached state for this exchange is thrown away
+        since it may no longer agree with the database. nested blocks join the outermost one.
+        '''
+        if self._pending_confirmations is not None:
+            yield
+            return
+
+        pending = self._pending_confirmations = []
+        depth_changes = self._depth_changes = set()
+        try:
+            with transaction.atomic():
+                if getattr(self.group, 'sharded_event_processing', False):
+                    # hold a lock on this exchange's row so that no other process can match against this book at the same time
+                    type(self).objects.select_for_update().values_list('pk').get(pk=self.pk)
+                yield
+        except Exception:
+            self._discard_cached_state()
+            raise
+        finally:
+            self._pending_confirmations = None
+            self._depth_changes = None
+        if batch:
+            if pending:
+                self.group.confirm_batch(pending)
+        else:
+            for channel, obj in pending:
+                getattr(self.group, channel)(obj)
+        if depth_changes and getattr(self.group, 'depth_messages', False):
+            self.group.confirm_depth(self.asset_name, self._get_depth_update(depth_changes))
+
     def enter_order(self, price, volume, is_bid, pcode):
         '''enter a bid or ask into the exchange'''
-        order = self.orders.create(
-            price  = price,
-            volume = volume,
-            is_bid = is_bid,
-            pcode  = pcode
-        )
+        with self._matching_transaction():
+            # load the cached order index and book before the new order exists, so that they're loaded without it and it's
+            # only added to them if it ends up resting in the book
+            self._get_order_index()
+            if self._uses_memory_book():
+                self._get_memory_book()
+            order = self.orders.create(
+                price  = price,
+                volume = volume,
+                is_bid = is_bid,
+                pcode  = pcode
+            )
 
-        if is_bid:
-            self._handle_insert_bid(order)
-        else:
-            self._handle_insert_ask(order)
+            if is_bid:
+                self._handle_insert_bid(order)
+            else:
+                self._handle_insert_ask(order)
     
     def enter_market_order(self, volume, is_bid, pcode):
         '''enter a market order into the exchange
@@ -71,136 +358,197 @@ class CDAExchange(BaseExchange):
         a market bid has effective price 0 and a market ask has effective price infinity.
         additionally, market orders are not entered into the book if they don't immediately
         transact'''
-        if is_bid:
-            self._handle_bid_market_order(volume, pcode)
-        else:
-            self._handle_ask_market_order(volume, pcode)
+        with self._matching_transaction():
+            if is_bid:
+                self._handle_bid_market_order(volume, pcode)
+            else:
+                self._handle_ask_market_order(volume, pcode)
 
     def cancel_order(self, order_id):
         '''cancel an already entered order'''
-        canceled_order = self._get_order(order_id)
-        if canceled_order.status != OrderStatusEnum.ACTIVE:
-            logger.error(f'Cancel attempted on inactive order with id {order_id}')
-            return
+        with self._matching_transaction():
+            canceled_order = self._get_active_order(order_id)
+            if canceled_order is None:
+                logger.error(f'Cancel attempted on missing or inactive order with id {order_id}')
+                return
 
-        canceled_order.status = OrderStatusEnum.CANCELED
-        canceled_order.time_inactive = timezone.now()
-        canceled_order.save()
-        self.group.confirm_cancel(canceled_order)
+            canceled_order.status = OrderStatusEnum.CANCELED
+            canceled_order.time_inactive = timezone.now()
+            canceled_order.save()
+            self._book_remove(canceled_order)
+            self._send_cancel_confirmation(canceled_order)
     
     def accept_immediate(self, accepted_order_id, taker_pcode):
         '''directly trade with the order with id `accepted_order_id`
         
         this creates a new order and trades it directly with the order with id `order_id`,
-        fully filling the accepted order'''
-        accepted_order = self._get_order(accepted_order_id)
-        if accepted_order.status != OrderStatusEnum.ACTIVE:
-            logger.error(f'Accept attempted on inactive order with id {accepted_order_id}')
-            return
+        filling all of the accepted order's remaining volume'''
+        with self._matching_transaction():
+            accepted_order = self._get_active_order(accepted_order_id)
+            if accepted_order is None:
+                logger.error(f'Accept attempted on missing or inactive order with id {accepted_order_id}')
+                return
 
-        now = timezone.now()
-        taking_order = self.orders.create(
-            timestamp = now,
-            time_inactive = now,
-            status = OrderStatusEnum.ACCEPTED_TAKER,
-            price  = accepted_order.price,
-            volume = accepted_order.volume,
-            is_bid = not accepted_order.is_bid,
-            pcode  = taker_pcode,
-            traded_volume = accepted_order.volume,
-        )
+            now = timezone.now()
+            taking_order = self.orders.create(
+                timestamp = now,
+                time_inactive = now,
+                status = OrderStatusEnum.ACCEPTED_TAKER,
+                price  = accepted_order.price,
+                volume = accepted_order.remaining_volume,
+                is_bid = not accepted_order.is_bid,
+                pcode  = taker_pcode,
+                traded_volume = accepted_order.remaining_volume,
+            )
 
-        trade = self.trades.create(timestamp=now, taking_order=taking_order)
+            trade = self.trades.create(timestamp=now, taking_order=taking_order)
+            Fill.objects.create(**self._fill_fields(trade, accepted_order, taking_order, accepted_order.remaining_volume))
 
-        accepted_order.status = OrderStatusEnum.ACCEPTED_MAKER
-        accepted_order.time_inactive = now
-        accepted_order.making_trade = trade
-        accepted_order.traded_volume = accepted_order.volume
-        accepted_order.save()
+            fill_volume = accepted_order.remaining_volume
+            accepted_order.status = OrderStatusEnum.ACCEPTED_MAKER
+            accepted_order.time_inactive = now
+            accepted_order.traded_volume = accepted_order.volume
+            accepted_order.save()
+            self._book_fill(accepted_order, fill_volume)
+            self._book_remove(accepted_order)
 
-        self._send_trade_confirmation(trade)
+            self._send_trade_confirmation(trade)
     
+    def enter_orders(self, orders):
+        '''enter several bids or asks into the exchange at once
+
+        `orders` is a list of dicts with the keys 'price', 'volume', 'is_bid' and 'pcode'. the orders are entered in
+        order in a single transaction, and all the resulting confirmations are sent in one batch message'''
+        with self._matching_transaction(batch=True):
+            for order in orders:
+                self.enter_order(order['price'], order['volume'], order['is_bid'], order['pcode'])
+
+    def cancel_orders(self, order_ids):
+        '''cancel several already entered orders at once, sending all the confirmations in one batch message'''
+        order_ids = set(order_ids)
+        with self._matching_transaction(batch=True):
+            index = self._get_order_index()
+            canceled_orders = [index[order_id] for order_id in order_ids if order_id in index]
+            if len(canceled_orders) != len(order_ids):
+                inactive_ids = order_ids - {o.id for o in canceled_orders}
+                logger.error(f'Cancel attempted on missing or inactive orders with ids {sorted(inactive_ids)}')
+            self._cancel_many(canceled_orders)
+
+    def cancel_all(self, pcode, side=None):
+        '''cancel all of a player's active orders at once, sending all the confirmations in one batch message
+
+        if side is 'bid' or 'ask', only that player's bids or asks are canceled'''
+        if side not in (None, 'bid', 'ask'):
+            raise ValueError(f'invalid side "{side}", expected "bid" or "ask"')
+        with self._matching_transaction(batch=True):
+            canceled_orders = [
+                o for o in self._get_order_index().values()
+                if o.pcode == pcode and (side is None or o.is_bid == (side == 'bid'))
+            ]
+            self._cancel_many(sorted(canceled_orders, key=lambda o: o.timestamp))
+
+    def _cancel_many(self, canceled_orders):
+        '''cancel a list of active orders with a single bulk update. this should be called inside a matching transaction'''
+        if canceled_orders:
+            now = timezone.now()
+            for order in canceled_orders:
+                order.status = OrderStatusEnum.CANCELED
+                order.time_inactive = now
+                self._book_remove(order)
+                self._send_cancel_confirmation(order)
+            Order.objects.bulk_update(canceled_orders, ['status', 'time_inactive'])
+
     def _handle_insert_bid(self, bid_order):
         '''handle a bid being inserted into the order book, transacting if necessary'''
         # if this order isn't aggressive enough to transact with the best ask, just enter it
-        best_ask = self._get_best_ask()
-        if not best_ask or bid_order.price < best_ask.price:
+        best_ask = self._get_quote(is_bid=False)
+        if not best_ask or bid_order.price < best_ask['price']:
+            self._book_insert(bid_order)
             self._send_enter_confirmation(bid_order)
             return
 
-        asks = self._get_asks_qset()
         trade = self.trades.create(taking_order=bid_order)
-        cur_volume = bid_order.volume
-        for ask in asks:
-            if cur_volume == 0 or bid_order.price < ask.price:
-                break
-            if cur_volume >= ask.volume:
-                cur_volume -= ask.volume
-                ask.traded_volume = ask.volume
-            else:
-                self._enter_partial(ask, ask.volume - cur_volume)
-                ask.traded_volume = cur_volume
-                cur_volume = 0
-            ask.making_trade = trade
-            ask.status = OrderStatusEnum.TRADED_MAKER
-            ask.time_inactive = trade.timestamp
-            ask.save()
-        if cur_volume > 0:
-            self._enter_partial(bid_order, cur_volume)
-        bid_order.traded_volume = bid_order.volume - cur_volume
-        bid_order.status = OrderStatusEnum.TRADED_TAKER
-        bid_order.time_inactive = trade.timestamp
-        bid_order.save()
-        self._send_trade_confirmation(trade)
+        self._handle_limit_trade(trade, bid_order, self._iter_asks())
     
     def _handle_insert_ask(self, ask_order):
         '''handle an ask being inserted into the order book, transacting if necessary'''
         # if this order isn't aggressive enough to transact with the best bid, just enter it
-        best_bid = self._get_best_bid()
-        if not best_bid or ask_order.price > best_bid.price:
+        best_bid = self._get_quote(is_bid=True)
+        if not best_bid or ask_order.price > best_bid['price']:
+            self._book_insert(ask_order)
             self._send_enter_confirmation(ask_order)
             return
 
-        bids = self._get_bids_qset()
         trade = self.trades.create(taking_order=ask_order)
-        cur_volume = ask_order.volume
-        for bid in bids:
-            if cur_volume == 0 or ask_order.price > bid.price :
-                break
-            if cur_volume >= bid.volume:
-                cur_volume -= bid.volume
-                bid.traded_volume = bid.volume
-            else:
-                self._enter_partial(bid, bid.volume - cur_volume)
-                bid.traded_volume = cur_volume
-                cur_volume = 0
-            bid.making_trade = trade
-            bid.status = OrderStatusEnum.TRADED_MAKER
-            bid.time_inactive = trade.timestamp
-            bid.save()
+        self._handle_limit_trade(trade, ask_order, self._iter_bids())
+
+    def _handle_limit_trade(self, trade, taking_order, making_orders):
+        '''trade an aggressive limit order against the other side of the book
+
+        if the order isn't completely filled, it stays in the market with its remaining volume'''
+        cur_volume = self._fill_making_orders(
+            trade, taking_order, making_orders, OrderStatusEnum.TRADED_MAKER, check_price=True)
+
+        taking_order.traded_volume = taking_order.volume - cur_volume
         if cur_volume > 0:
-            self._enter_partial(ask_order, cur_volume)
-        ask_order.traded_volume = ask_order.volume - cur_volume
-        ask_order.status = OrderStatusEnum.TRADED_TAKER
-        ask_order.time_inactive = trade.timestamp
-        ask_order.save()
+            taking_order.save()
+            self._book_insert(taking_order)
+            self._send_enter_confirmation(taking_order)
+        else:
+            taking_order.status = OrderStatusEnum.TRADED_TAKER
+            taking_order.time_inactive = trade.timestamp
+            taking_order.save()
         self._send_trade_confirmation(trade)
-    
-    def _enter_partial(self, order, new_volume):
-        '''reenter an order that's been partially filled'''
-        new_order = self.orders.create(
-            timestamp = order.timestamp,
-            price     = order.price,
-            volume    = new_volume,
-            is_bid    = order.is_bid,
-            pcode     = order.pcode
-        )
-        self._send_enter_confirmation(new_order)
+
+    def _fill_making_orders(self, trade, taking_order, making_orders, making_status, check_price):
+        '''fill `taking_order` against `making_orders`, an iterable of resting orders in priority order
+
+        the making orders are written with a single bulk update, and a Fill is created for each of them in a single
+        bulk insert. making orders that are only partly filled stay in the market with their remaining volume.
+        if check_price is true, filling stops at the first making order whose price doesn't cross the taking order's price.
+        returns the taking order's unfilled volume.
+        '''
+        cur_volume = taking_order.volume
+        making_orders_traded = []
+        fills = []
+        for making_order in making_orders:
+            if cur_volume == 0:
+                break
+            if check_price and (making_order.price > taking_order.price if taking_order.is_bid else making_order.price < taking_order.price):
+                break
+            fill_volume = min(cur_volume, making_order.remaining_volume)
+            cur_volume -= fill_volume
+            making_order.traded_volume = (making_order.traded_volume or 0) + fill_volume
+            self._book_fill(making_order, fill_volume)
+            if making_order.remaining_volume == 0:
+                making_order.status = making_status
+                making_order.time_inactive = trade.timestamp
+                self._book_remove(making_order)
+            making_orders_traded.append(making_order)
+            fills.append(Fill(**self._fill_fields(trade, making_order, taking_order, fill_volume)))
+        # the best level on the making side was traded with, so its cached quote is out of date
+        self._invalidate_quote(not taking_order.is_bid)
+        Order.objects.bulk_update(making_orders_traded, ['traded_volume', 'status', 'time_inactive'])
+        Fill.objects.bulk_create(fills)
+        return cur_volume
+
+    def _fill_fields(self, trade, making_order, taking_order, volume):
+        '''get the field values for a Fill of `volume` units of `making_order` in `trade`'''
+        return {
+            'exchange': self,
+            'timestamp': trade.timestamp,
+            'trade': trade,
+            'making_order': making_order,
+            'taking_order': taking_order,
+            'price': making_order.price,
+            'volume': volume,
+            'asset_name': self.asset_name,
+        }
 
     def _handle_bid_market_order(self, volume, pcode):
         '''enter a bid market order'''
         # if there are no asks, just exit without doing anything
-        if volume == 0 or not self._get_best_ask():
+        if volume == 0 or not self._get_quote(is_bid=False):
             return
         
         # use one datetime object for all timestamp updates so that
@@ -218,32 +566,12 @@ class CDAExchange(BaseExchange):
             pcode  = pcode,
         )
         trade = self.trades.create(timestamp=now, taking_order=taking_order)
-
-        asks = self._get_asks_qset()
-        cur_volume = volume
-        for ask in asks:
-            if cur_volume == 0:
-                break
-            if cur_volume >= ask.volume:
-                cur_volume -= ask.volume
-                ask.traded_volume = ask.volume
-            else:
-                self._enter_partial(ask, ask.volume - cur_volume)
-                ask.traded_volume = cur_volume
-                cur_volume = 0
-            ask.making_trade = trade
-            ask.status = OrderStatusEnum.MARKET_MAKER
-            ask.time_inactive = now
-            ask.save()
-        taking_order.traded_volume = volume - cur_volume
-        taking_order.time_inactive = now
-        taking_order.save()
-        self._send_trade_confirmation(trade)
+        self._handle_market_trade(trade, taking_order, self._iter_asks())
 
     def _handle_ask_market_order(self, volume, pcode):
         '''enter an ask market order'''
         # if there are no asks, just exit without doing anything
-        if volume == 0 or not self._get_best_bid():
+        if volume == 0 or not self._get_quote(is_bid=True):
             return
 
         # use one datetime object for all timestamp updates so that
@@ -262,35 +590,39 @@ class CDAExchange(BaseExchange):
             pcode  = pcode,
         )
         trade = self.trades.create(timestamp=now, taking_order=taking_order)
+        self._handle_market_trade(trade, taking_order, self._iter_bids())
 
-        bids = self._get_bids_qset()
-        cur_volume = volume
-        for bid in bids:
-            if cur_volume == 0:
-                break
-            if cur_volume >= bid.volume:
-                cur_volume -= bid.volume
-                bid.traded_volume = bid.volume
-            else:
-                self._enter_partial(bid, bid.volume - cur_volume)
-                bid.traded_volume = cur_volume
-                cur_volume = 0
-            bid.making_trade = trade
-            bid.status = OrderStatusEnum.MARKET_MAKER
-            bid.time_inactive = now
-            bid.save()
-        taking_order.traded_volume = volume - cur_volume
-        taking_order.time_inactive = now
+    def _handle_market_trade(self, trade, taking_order, making_orders):
+        '''trade a market order against the other side of the book. whatever isn't filled is dropped'''
+        cur_volume = self._fill_making_orders(
+            trade, taking_order, making_orders, OrderStatusEnum.MARKET_MAKER, check_price=False)
+
+        taking_order.traded_volume = taking_order.volume - cur_volume
         taking_order.save()
         self._send_trade_confirmation(trade)
+
+    def _send_confirmation(self, channel, obj):
+        '''call the group's confirmation method for `channel`, holding it until commit if inside a matching transaction'''
+        if self._pending_confirmations is not None:
+            # an order can still change before the transaction commits, e.g. when a later order in the same batch trades
+            # with it, so queue a copy of it as it is now. the confirmation then reserves and reports what was entered
+            if isinstance(obj, Order):
+                obj = copy.copy(obj)
+            self._pending_confirmations.append((channel, obj))
+        else:
+            getattr(self.group, channel)(obj)
     
     def _send_enter_confirmation(self, order):
         '''send an order enter confirmation to the group'''
-        self.group.confirm_enter(order)
+        self._send_confirmation('confirm_enter', order)
 
     def _send_trade_confirmation(self, trade):
         '''send a trade confirmation to the group'''
-        self.group.confirm_trade(trade)
+        self._send_confirmation('confirm_trade', trade)
+
+    def _send_cancel_confirmation(self, order):
+        '''send an order cancel confirmation to the group'''
+        self._send_confirmation('confirm_cancel', order)
     
     def __str__(self):
-        return '\n'.join(' ' + str(e) for e in chain(self._get_bids_qset(), self._get_asks_qset()))
\ No newline at end of file
+        return '\n'.join(' ' + str(e) for e in chain(self._get_bids_qset(), self._get_asks_qset()))
@@ -0,0 +1,155 @@
+import bisect
+from itertools import islice
+from collections import deque
+
+
+class BookSide:
+    '''one side (bids or asks) of an in-memory order book
+
+    orders are grouped into price levels. the prices of all levels are kept in a sorted list, and each level
+    is a FIFO queue of the orders resting at that price, oldest first.
+    '''
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self._prices = []
+        '''sorted (ascending) list of every price with at least one resting order'''
+        self._levels = {}
+        '''dict mapping prices to a deque of orders at that price'''
+        self._ids = set()
+        '''ids of every order on this side of the book'''
+
+    def insert(self, order):
+        '''add an order to this side of the book. does nothing if an order with the same id is already in the book'''
+        if order.id in self._ids:
+            return
+        self._ids.add(order.id)
+        level = self._levels.get(order.price)
+        if level is None:
+            bisect.insort(self._prices, order.price)
+            level = self._levels[order.price] = deque()
+
+        # new orders almost always go at the back of their level, but partially filled orders are
+        # re-entered with their original timestamp, so they need to keep their place in line
+        if not level or level[-1].timestamp <= order.timestamp:
+            level.append(order)
+            return
+        for i, resting in enumerate(level):
+            if resting.timestamp > order.timestamp:
+                level.insert(i, order)
+                return
+
+    def remove(self, order):
+        '''remove an order from this side of the book. does nothing if the order isn't in the book'''
+        level = self._levels.get(order.price)
+        if level is None or order.id not in self._ids:
+            return
+        self._ids.discard(order.id)
+        for resting in level:
+            if resting.id == order.id:
+                level.remove(resting)
+                break
+        if not level:
+            del self._levels[order.price]
+            del self._prices[bisect.bisect_left(self._prices, order.price)]
+
+    def best_level(self):
+        '''get the orders at the best price on this side of the book in priority order, or None if this side is empty'''
+        if not self._prices:
+            return None
+        best_price = self._prices[-1] if self.is_bid else self._prices[0]
+        return self._levels[best_price]
+
+    def best(self):
+        '''get the order with the highest priority on this side of the book, or None if this side is empty'''
+        level = self.best_level()
+        return level[0] if level else None
+
+    def __iter__(self):
+        '''iterate through the orders on this side of the book in priority order
+
+        each level is copied before it's iterated over, so orders can safely be removed from the book
+        while iterating
+        '''
+        prices = reversed(self._prices) if self.is_bid else self._prices
+        for price in list(prices):
+            yield from list(self._levels.get(price, ()))
+
+    def __len__(self):
+        return sum(len(level) for level in self._levels.values())
+
+
+class OrderBook:
+    '''an in-memory price-time priority order book
+
+    this holds the Order objects for every active order in an exchange, and is used by CDAExchange when
+    running with an in-memory book. it's just an index; the database is still the source of truth and the
+    book is rebuilt from the active orders in the database whenever it's missing.
+    '''
+
+    def __init__(self, orders=()):
+        self.bids = BookSide(is_bid=True)
+        '''bids, sorted by descending price then ascending timestamp'''
+        self.asks = BookSide(is_bid=False)
+        '''asks, sorted by ascending price then ascending timestamp'''
+        for order in orders:
+            self.insert(order)
+
+    def _side(self, order):
+        return self.bids if order.is_bid else self.asks
+
+    def insert(self, order):
+        '''add an active order to the book'''
+        self._side(order).insert(order)
+
+    def remove(self, order):
+        '''remove an order from the book'''
+        self._side(order).remove(order)
+
+
+class DepthSide:
+    '''the total remaining volume at each price on one side (bids or asks) of an order book'''
+
+    def __init__(self, is_bid):
+        self.is_bid = is_bid
+        self._prices = []
+        '''sorted (ascending) list of every price with some volume'''
+        self._volumes = {}
+        '''dict mapping prices to the total remaining volume at that price'''
+
+    def add(self, price, volume):
+        '''add `volume` to the total at `price`. volume is negative when orders are filled or removed'''
+        total = self._volumes.get(price, 0) + volume
+        if total > 0:
+            if price not in self._volumes:
+                bisect.insort(self._prices, price)
+            self._volumes[price] = total
+        elif price in self._volumes:
+            del self._volumes[price]
+            del self._prices[bisect.bisect_left(self._prices, price)]
+
+    def volume(self, price):
+        '''get the total volume at `price`, or 0 if there isn't any'''
+        return self._volumes.get(price, 0)
+
+    def levels(self, n=None):
+        '''get a list of [price, volume] pairs for the best `n` price levels on this side in priority order, or for every
+        level if n is None'''
+        prices = reversed(self._prices) if self.is_bid else iter(self._prices)
+        return [[price, self._volumes[price]] for price in islice(prices, n)]
+
+
+class Depth:
+    '''the aggregated depth of an order book, i.e. the total remaining volume at each price on each side
+
+    CDAExchange keeps one of these up to date for each exchange as orders are entered, filled and canceled'''
+
+    def __init__(self, orders=()):
+        self.bids = DepthSide(is_bid=True)
+        self.asks = DepthSide(is_bid=False)
+        for order in orders:
+            self.add(order.is_bid, order.price, order.remaining_volume)
+
+    def add(self, is_bid, price, volume):
+        '''add `volume` to the total at `price` on one side of the book'''
+        (self.bids if is_bid else self.asks).add(price, volume)
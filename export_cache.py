@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import close_old_connections
+from django.db.models import Count, Max
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import uuid
+
+from .models import Group as MarketGroup
+from .exchange.base import Order, Fill
+from .output import get_output_generators
+
+logger = logging.getLogger(__name__)
+
+_build_locks = {}
+'''locks making sure each export is only built once at a time, keyed by (session code, output generator class name)'''
+_build_locks_lock = threading.Lock()
+
+_prebuilding = set()
+'''codes of the sessions whose exports are currently being built in the background'''
+_prebuilding_lock = threading.Lock()
+
+
+def get_cache_dir():
+    '''get the directory exports are cached in. this can be changed with the MARKETS_EXPORT_CACHE_DIR setting'''
+    return getattr(settings, 'MARKETS_EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'otree_markets_exports'))
+
+def get_content_version(session):
+    '''get a string which changes whenever an order or fill in a session is added or changed
+
+    this only looks at orders and fills, so it's only suitable for output generators which don't output anything else'''
+    exchange_ids = {}
+    for subsession in session.get_subsessions():
+        for group in subsession.get_groups():
+            if not isinstance(group, MarketGroup):
+                continue
+            field_names, rows = group._get_exchange_registry()
+            id_index = field_names.index('id')
+            content_type = ContentType.objects.get_for_model(group.exchanges.model)
+            exchange_ids.setdefault(content_type, []).extend(row[id_index] for row in rows.values())
+
+    version = []
+    for content_type, ids in exchange_ids.items():
+        # orders only change when they become inactive or are partially filled, which also creates a fill
+        version.append(Order.objects.filter(content_type=content_type, object_id__in=ids)
+                                    .aggregate(Count('id'), Max('id'), Max('time_inactive')))
+        version.append(Fill.objects.filter(content_type=content_type, object_id__in=ids)
+                                   .aggregate(Count('id'), Max('id')))
+    return hashlib.sha1(repr(version).encode()).hexdigest()[:16]
+
+def get_cache_path(output_generator):
+    '''get the path the output of an output generator is cached at for the current content version of its session.
+    the file at this path might not exist yet
+
+    the output is stored as <cache dir>/<session code>/<generator class name>-<content version>'''
+    session = output_generator.session
+    name = type(output_generator).__name__
+    return os.path.join(get_cache_dir(), session.code, f'{name}-{get_content_version(session)}')
+
+def get_export_path(output_generator, path=None):
+    '''get the path to the cached output of an output generator, building it first if it isn't cached or is out of date
+
+    path is the output's cache path from get_cache_path, if it's already been looked up. older versions are deleted when
+    a new one is built'''
+    if path is None:
+        path = get_cache_path(output_generator)
+    if os.path.exists(path):
+        return path
+
+    with _build_locks_lock:
+        lock = _build_locks.setdefault((output_generator.session.code, type(output_generator).__name__), threading.Lock())
+    with lock:
+        if os.path.exists(path):
+            return path
+        # write to a temporary file first so a half-written export is never served
+        tmp_path = _get_tmp_path(path)
+        try:
+            with open(tmp_path, 'wb') as f:
+                _write_output(output_generator, _FileWriter(f))
+            _finish_build(path, tmp_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return path
+
+def iter_and_cache_output(output_generator, path):
+    '''a generator which yields the output of a streaming output generator while saving it to its cache path `path`
+
+    this lets a download that isn't cached yet start right away instead of waiting for the whole file to be built.
+    nothing is saved if the download is stopped before the end'''
+    tmp_path = _get_tmp_path(path)
+    try:
+        with open(tmp_path, 'wb') as f:
+            writer = _FileWriter(f)
+            for chunk in output_generator.iter_output():
+                writer.write(chunk)
+                yield chunk
+        _finish_build(path, tmp_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def _get_tmp_path(path):
+    '''get a unique temporary path to build the cache file at `path` in, creating its directory if necessary'''
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+def _finish_build(path, tmp_path):
+    '''move a finished export from `tmp_path` into place at `path` and delete the older versions of it'''
+    os.replace(tmp_path, path)
+    session_dir, filename = os.path.split(path)
+    prefix = filename.rsplit('-', 1)[0] + '-'
+    for other in os.listdir(session_dir):
+        if other.startswith(prefix) and other != filename and not other.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(session_dir, other))
+            except FileNotFoundError:
+                pass
+
+def prebuild_exports(session):
+    '''build the cached output of every cacheable output generator for a session in a background thread
+
+    does nothing if the exports for this session are already being built'''
+    with _prebuilding_lock:
+        if session.code in _prebuilding:
+            return
+        _prebuilding.add(session.code)
+    thread = threading.Thread(target=_prebuild_exports, args=(session,), name=f'otree_markets-export-{session.code}', daemon=True)
+    thread.start()
+
+def _prebuild_exports(session):
+    try:
+        for output_generator_class in get_output_generators(session.config):
+            if output_generator_class.cache_output:
+                get_export_path(output_generator_class(session))
+    except Exception:
+        logger.exception('error prebuilding market exports for session {}'.format(session.code))
+    finally:
+        with _prebuilding_lock:
+            _prebuilding.discard(session.code)
+        close_old_connections()
+
+def _write_output(output_generator, f):
+    if output_generator.streaming:
+        for chunk in output_generator.iter_output():
+            f.write(chunk)
+    else:
+        output_generator.write_output(f)
+
+
+class _FileWriter():
+    '''a file-like object which writes both strings and bytes to a binary file, like an HttpResponse does'''
+
+    def __init__(self, f):
+        self.f = f
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.f.write(data)
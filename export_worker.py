@@ -0,0 +1,23 @@
+'''functions run in the worker processes used for parallel exports. see BaseMarketOutputGenerator.map_market_groups
+
+workers are started with the spawn method, so they import this module before django is set up. that's why nothing
+here imports django models at the top level'''
+import inspect
+
+
+def init_export_worker():
+    '''set up django in a new worker process'''
+    from django.apps import apps
+    if not apps.ready:
+        import django
+        django.setup()
+
+def run_group_export(task):
+    '''run one group's part of a parallel export'''
+    from django.apps import apps
+    from otree.models import Session
+    output_generator_class, session_pk, group_model_label, group_pk, method_name = task
+    output_generator = output_generator_class(Session.objects.get(pk=session_pk))
+    group = apps.get_model(group_model_label).objects.get(pk=group_pk)
+    result = getattr(output_generator, method_name)(group)
+    return list(result) if inspect.isgenerator(result) else result
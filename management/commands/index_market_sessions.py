@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from otree.models import Session
+
+from otree_markets.session_index import MarketSessionIndex
+
+
+class Command(BaseCommand):
+    help = 'add sessions created before the markets session index existed to the index used by the markets data export pages'
+
+    def handle(self, *args, **options):
+        indexed = set(MarketSessionIndex.objects.values_list('session_id', flat=True))
+        # every session is indexed, not just markets sessions, since old sessions' apps might not exist anymore.
+        # the export pages only ever look up markets configs, so the extra rows are never shown
+        new_rows = [
+            MarketSessionIndex(session_id=session_id, config_name=config['name'])
+            for session_id, config in Session.objects.values_list('id', 'config').iterator()
+            if session_id not in indexed
+        ]
+        MarketSessionIndex.objects.bulk_create(new_rows, batch_size=1000, ignore_conflicts=True)
+        self.stdout.write(f'indexed {len(new_rows)} sessions')
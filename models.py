@@ -6,16 +6,59 @@ from otree_redwood.models import Group as RedwoodGroup
 from jsonfield import JSONField
 from django.utils import timezone
 from django.contrib.contenttypes.fields import GenericRelation
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
+import threading
 import logging
+import copy
+import time
 
 from .exchange.cda_exchange import CDAExchange
-from .exchange.base import Order, Trade
+from .exchange.base import Order, Trade, register_exchange
+from .dispatch import get_dispatcher, get_outbox, discard_outbox, get_event_ring, discard_event_ring, STREAM_EPOCH
+from .compact import CompactEncoder
+from .consumers import send_to_participant
+from .session_index import MarketSessionIndex
 
 SINGLE_ASSET_NAME = 'A'
 '''the name of the only asset when in single-asset mode'''
 
 logger = logging.getLogger(__name__)
 
+_exchange_registry = {}
+'''the exchanges belonging to each group, keyed by (model label, group id)
+
+each value is a tuple of the exchange model's field names and a dict mapping asset names to the database row for that
+asset's exchange. exchanges never change after they're created, so this only needs to be cleared to free memory once
+trading in a group is over
+'''
+
+_holdings_locks = {}
+'''locks serializing holdings updates within each group when events are processed in parallel, keyed by (model label, group id)'''
+
+_message_encoders = {}
+'''CompactEncoders for each group using compact messages, keyed by (model label, group id)'''
+
+_market_snapshots = {}
+'''the most recent snapshot of each exchange, keyed by (model label, group id, asset name)
+
+each value is a tuple of the exchange's sequence number when the snapshot was taken and the snapshot. a snapshot is
+still current as long as no messages have been sent for its exchange since'''
+
+_market_snapshot_locks = {}
+'''locks making sure only one snapshot of each exchange is built at a time, keyed the same as _market_snapshots'''
+
+_players_left = {}
+'''ids of the players in each group who have left the market page, keyed by (model label, group id)
+
+the process-wide state in this module and in cda_exchange.py and dispatch.py is freed once every player in a group has
+left, see Group.player_left_market'''
+_groups_done = {}
+'''ids of the groups in each subsession where every player has left the market page, keyed by (model label, subsession id)'''
+_players_left_lock = threading.Lock()
+
 class Subsession(BaseSubsession):
 
     class Meta(BaseSubsession.Meta):
@@ -28,16 +71,61 @@ class Subsession(BaseSubsession):
         return [SINGLE_ASSET_NAME]
     
     def create_exchanges(self):
+        '''create one exchange for each asset in each group, all in a single bulk insert.
+        returns the number of groups exchanges were created for'''
         asset_names = self.asset_names()
+        groups = self.get_groups()
+        if not groups:
+            return 0
+        exchange_model = groups[0].exchanges.model
+        exchange_model.objects.bulk_create([
+            exchange_model(group=group, asset_name=name)
+            for group in groups
+            for name in asset_names
+        ])
+        return len(groups)
 
-        for group in self.get_groups():
-            for name in asset_names:
-                group.exchanges.create(asset_name=name)
+    def set_endowments(self):
+        '''set the endowments of every player in this subsession, saving them all in a single bulk update.
+        returns the number of players
+
+        players whose class overrides Player.set_endowments are set up by calling their set_endowments() one at a time
+        instead, since the override may set and save fields other than the holdings'''
+        players = self.get_players()
+        bulk_players = []
+        for player in players:
+            if type(player).set_endowments is Player.set_endowments:
+                player.set_endowments(save=False)
+                bulk_players.append(player)
+            else:
+                player.set_endowments()
+        if bulk_players:
+            type(bulk_players[0])._default_manager.bulk_update(bulk_players, Player.holdings_fields)
+        return len(players)
 
     def creating_session(self):
-        self.create_exchanges()
-        for player in self.get_players():
-            player.set_endowments()
+        if self.round_number == 1:
+            MarketSessionIndex.index_session(self.session)
+
+        start = time.perf_counter()
+        num_groups = self.create_exchanges()
+        exchanges_done = time.perf_counter()
+        num_players = self.set_endowments()
+        endowments_done = time.perf_counter()
+
+        # report how long setup took so we can keep track of how it scales with the number of groups and assets
+        logger.info(
+            'markets setup for round {}: {} groups x {} assets, {} players. '
+            'exchanges {:.1f}ms, endowments {:.1f}ms, total {:.1f}ms'.format(
+                self.round_number,
+                num_groups,
+                len(self.asset_names()),
+                num_players,
+                (exchanges_done - start) * 1000,
+                (endowments_done - exchanges_done) * 1000,
+                (endowments_done - start) * 1000,
+            )
+        )
 
 
 class Group(RedwoodGroup):
@@ -50,6 +138,47 @@ class Group(RedwoodGroup):
     change this property to swap out a different exchange implementation'''
     exchanges = GenericRelation(exchange_class)
     '''a queryset of all the exchanges associated with this group'''
+    memory_order_book = False
+    '''set this property to True to have this group's exchanges match orders against an in-memory order book
+    instead of querying the database for every order. the database is still written to after every match, and the
+    in-memory book is rebuilt from it when the server restarts. this assumes all of a group's messages are handled
+    by a single server process'''
+    sharded_event_processing = False
+    '''set this property to True to process this group's enter, cancel and accept messages on a pool of worker threads
+    instead of in the websocket handler. each exchange's messages are processed strictly in the order they arrived,
+    while messages for different exchanges (in this group or in other groups) are processed in parallel. exchange rows
+    are also locked for the duration of each match. players' holdings are checked and reserved under a per-group lock
+    before an order is matched, so orders for different assets in the same group can't spend the same cash. this assumes
+    all of a group's messages are handled by a single server process'''
+    event_workers = 4
+    '''the number of worker threads used when sharded_event_processing is set'''
+    batch_messages = False
+    '''set this property to True to send all the messages caused by each message from the frontend together in a single
+    'batch' message instead of sending every confirmation separately. this cuts down on the number of websocket frames
+    sent to each player when a single order causes several trades'''
+    batch_window = 0
+    '''when batch_messages is set, hold outgoing messages for this many milliseconds and send everything sent during that
+    time in a single 'batch' message, so messages caused by different frontend messages are batched together too.
+    this assumes all of a group's messages are handled by a single server process'''
+    compact_messages = False
+    '''set this property to True to send order and trade confirmations in a compact format, where orders are arrays instead
+    of dicts and participant codes and asset names are replaced by small integers. trader_state decodes these automatically.
+    see message_types.txt for the format'''
+    resync_buffer_size = 1000
+    '''the number of recent messages kept in memory for each exchange, so that a trader who loses their connection can be
+    sent just the messages they missed when they reconnect. traders who missed more than this are sent a full snapshot
+    of the exchange instead. this assumes all of a group's messages are handled by a single server process'''
+    depth_messages = False
+    '''set this property to True to send a 'depth' message after every change to an exchange's book, with the new total
+    volume at each price level that changed. this lets frontends and bots which only need the price ladder follow it
+    without tracking every order. see CDAExchange.get_depth'''
+    prebuild_exports = False
+    '''set this property to True to start building the session's data exports in the background once every player in the
+    session has left the market page in the last round of the session's last markets app, so they're ready when someone
+    downloads them. only output generators with cache_output set are built'''
+    snapshot_trades = None
+    '''the maximum number of recent trades in each exchange sent to traders when they load a page or resync.
+    None means every trade is sent'''
 
     def get_remaining_time(self):
         '''gets the total amount of time remaining in the round'''
@@ -61,124 +190,593 @@ class Group(RedwoodGroup):
         else:
             return period_length
 
+    _players_by_pcode = None
+    '''dict mapping participant codes to this group's players, loaded once per event by _get_players_by_pcode'''
+    _changed_players = None
+    '''dict mapping ids to players whose holdings have changed and need to be saved, or None outside of _updating_holdings'''
+    _outbox = None
+    '''list of messages waiting to be sent when the current event is done, or None if messages aren't being held'''
+    _reservations = None
+    '''holdings reserved for the orders the current event is entering, or None if there aren't any. see _reserve_holdings'''
+
     def get_player(self, pcode) -> Player:
         '''get a player object given its participant code. can be overridden to return None for certain pcodes.
         this may be useful for bots or other situations where fake players are needed'''
-        for player in self.get_players():
-            if player.participant.code == pcode:
-                return player
-        raise ValueError('invalid player code: "{}"'.format(pcode))
+        try:
+            return self._get_players_by_pcode()[pcode]
+        except KeyError:
+            raise ValueError('invalid player code: "{}"'.format(pcode))
+
+    def get_exchange(self, asset_name):
+        '''get the exchange for the asset named `asset_name`
+
+        this uses a process-wide registry of each group's exchanges, so it doesn't query the database after the first call.
+        the returned exchange belongs to this group object, so confirmations from it come back to this object'''
+        field_names, rows = self._get_exchange_registry()
+        try:
+            row = rows[asset_name]
+        except KeyError:
+            raise ValueError('invalid asset name: "{}"'.format(asset_name))
+        exchange = self.exchanges.model.from_db(self._state.db, field_names, row)
+        exchange.group = self
+        return exchange
+
+    def get_exchanges(self):
+        '''get a list of all of this group's exchanges. see get_exchange'''
+        _, rows = self._get_exchange_registry()
+        return [self.get_exchange(asset_name) for asset_name in rows]
+
+    def _get_exchange_registry(self):
+        '''get the registry entry for this group's exchanges, loading it from the database if necessary'''
+        key = (self._meta.label, self.pk)
+        entry = _exchange_registry.get(key)
+        if entry is None:
+            exchange_model = self.exchanges.model
+            field_names = tuple(f.attname for f in exchange_model._meta.concrete_fields)
+            rows = {}
+            for row in self.exchanges.order_by('id').values_list(*field_names):
+                exchange = exchange_model.from_db(self._state.db, field_names, row)
+                register_exchange(exchange)
+                rows[exchange.asset_name] = row
+            entry = (field_names, rows)
+            # don't remember a group with no exchanges, they might just not have been created yet
+            if rows:
+                _exchange_registry[key] = entry
+        return entry
+
+    def _get_players_by_pcode(self):
+        '''get a dict mapping participant codes to this group's players
+
+        the players are loaded once and shared by everything that handles the current event'''
+        if self._players_by_pcode is None:
+            players = self.get_players()
+            prefetch_related_objects(players, 'participant')
+            self._players_by_pcode = {p.participant.code: p for p in players}
+        return self._players_by_pcode
+
+    def _reset_players(self):
+        '''forget the loaded players so they're reloaded from the database the next time they're needed'''
+        self._players_by_pcode = None
+
+    def _dispatch_event(self, asset_name, handler, event):
+        '''run `handler(event)` for a message concerning the exchange for `asset_name`
+
+        when sharded_event_processing is set, the handler runs later on the worker thread responsible for that exchange.
+        otherwise it runs immediately'''
+        if not self.sharded_event_processing:
+            self._handle_event(handler, event)
+            return
+        key = (self._meta.label, self.pk, asset_name)
+        get_dispatcher(self.event_workers).submit(key, self._handle_event, handler, event)
+
+    def _handle_event(self, handler, event):
+        '''run `handler(event)`. when batch_messages is set, everything it sends is held and sent together at the end'''
+        if not self.batch_messages:
+            handler(event)
+            return
+        self._outbox = []
+        try:
+            handler(event)
+        finally:
+            messages, self._outbox = self._outbox, None
+            self._release_messages(messages)
+
+    @contextmanager
+    def _updating_holdings(self):
+        '''update players' holdings inside this block, then save the holdings that changed for every player that was changed
+
+        if events are processed in parallel, this also holds this group's holdings lock and reloads the players, so that
+        holdings checked inside this block can't be used by other workers before they're saved'''
+        if self._changed_players is not None:
+            yield
+            return
+
+        lock = (_holdings_locks.setdefault((self._meta.label, self.pk), threading.Lock())
+                if self.sharded_event_processing else nullcontext())
+        with lock:
+            if self.sharded_event_processing:
+                self._reset_players()
+            self._changed_players = {}
+            try:
+                yield
+                changed_players = list(self._changed_players.values())
+            finally:
+                self._changed_players = None
+            if changed_players:
+                type(changed_players[0]).save_holdings(changed_players)
+
+    def _holdings_changed(self, player):
+        '''mark a player's holdings as changed so they're saved at the end of the current _updating_holdings block'''
+        if player is not None:
+            self._changed_players[player.pk] = player
 
     def _on_enter_event(self, event):
         '''handle an enter message sent from the frontend'''
+        asset_name = event.value['asset_name'] if event.value['asset_name'] else SINGLE_ASSET_NAME
+        self._dispatch_event(asset_name, self._process_enter_event, event)
+
+    def _on_cancel_event(self, event):
+        '''handle a cancel message sent from the frontend'''
+        self._dispatch_event(event.value['asset_name'], self._process_cancel_event, event)
+
+    def _on_accept_event(self, event):
+        '''handle an immediate accept message sent from the frontend'''
+        self._dispatch_event(event.value['asset_name'], self._process_accept_event, event)
+
+    def _on_enter_batch_event(self, event):
+        '''handle a message from the frontend entering several orders for one asset at once'''
+        asset_name = event.value['asset_name'] if event.value['asset_name'] else SINGLE_ASSET_NAME
+        self._dispatch_event(asset_name, self._process_enter_batch_event, event)
+
+    def _on_cancel_all_event(self, event):
+        '''handle a message from the frontend canceling all of a player's orders for one asset'''
+        asset_name = event.value['asset_name'] if event.value['asset_name'] else SINGLE_ASSET_NAME
+        self._dispatch_event(asset_name, self._process_cancel_all_event, event)
+
+    def _process_enter_event(self, event):
+        '''process an enter message sent from the frontend'''
+        self._reset_players()
         enter_msg = event.value
-        player = self.get_player(enter_msg['pcode'])
         asset_name = enter_msg['asset_name'] if enter_msg['asset_name'] else SINGLE_ASSET_NAME
-
-        if player and not player.check_available(enter_msg['is_bid'], enter_msg['price'], enter_msg['volume'], asset_name):
-            if enter_msg['is_bid']:
-                self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available cash')
-            if not enter_msg['is_bid']:
+        # check and reserve the player's holdings in one holdings update. when events are processed in parallel this holds
+        # the group's holdings lock, so no other worker can approve an order with the same holdings in between. the lock
+        # is released before the order is matched, so orders for different assets still match at the same time
+        with self._updating_holdings():
+            player = self.get_player(enter_msg['pcode'])
+            if player and not player.check_available(enter_msg['is_bid'], enter_msg['price'], enter_msg['volume'], asset_name):
+                if enter_msg['is_bid']:
+                    self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available cash')
+                if not enter_msg['is_bid']:
+                    if len(self.subsession.asset_names()) == 1:
+                        self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available assets')
+                    else:
+                        self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available amount of asset {}'.format(asset_name))
+                return
+            self._reserve_holdings(player, enter_msg['is_bid'], enter_msg['price'], enter_msg['volume'], asset_name)
+
+        with self._using_reservations():
+            exchange = self.get_exchange(asset_name)
+            order_id = exchange.enter_order(
+                enter_msg['price'],
+                enter_msg['volume'],
+                enter_msg['is_bid'],
+                enter_msg['pcode'],
+            )
+    
+    def _process_enter_batch_event(self, event):
+        '''process an enter_batch message sent from the frontend. either every order in the batch is entered or none are'''
+        self._reset_players()
+        pcode = event.participant.code
+        asset_name = event.value['asset_name'] if event.value['asset_name'] else SINGLE_ASSET_NAME
+        orders = [
+            {'price': o['price'], 'volume': o['volume'], 'is_bid': o['is_bid'], 'pcode': pcode}
+            for o in event.value['orders']
+        ]
+        if not orders:
+            return
+        # like _process_enter_event, but the whole batch is checked and reserved at once
+        with self._updating_holdings():
+            player = self.get_player(pcode)
+            if player and not player.check_available_orders(orders, asset_name):
                 if len(self.subsession.asset_names()) == 1:
-                    self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available assets')
+                    self._send_error(pcode, 'Orders rejected: insufficient available cash or assets')
                 else:
-                    self._send_error(enter_msg['pcode'], 'Order rejected: insufficient available amount of asset {}'.format(asset_name))
+                    self._send_error(pcode, 'Orders rejected: insufficient available cash or amount of asset {}'.format(asset_name))
+                return
+            for order in orders:
+                self._reserve_holdings(player, order['is_bid'], order['price'], order['volume'], asset_name)
+
+        with self._using_reservations():
+            self.get_exchange(asset_name).enter_orders(orders)
+
+    def _process_cancel_all_event(self, event):
+        '''process a cancel_all message sent from the frontend'''
+        self._reset_players()
+        asset_name = event.value['asset_name'] if event.value['asset_name'] else SINGLE_ASSET_NAME
+        side = event.value.get('side')
+        if side not in (None, 'bid', 'ask'):
+            logger.error('A player attempted to cancel all orders on an invalid side')
             return
+        self.get_exchange(asset_name).cancel_all(event.participant.code, side)
 
-        exchange = self.exchanges.get(asset_name=asset_name)
-        order_id = exchange.enter_order(
-            enter_msg['price'],
-            enter_msg['volume'],
-            enter_msg['is_bid'],
-            enter_msg['pcode'],
-        )
-    
-    def _on_cancel_event(self, event):
-        '''handle a cancel message sent from the frontend'''
+    def _process_cancel_event(self, event):
+        '''process a cancel message sent from the frontend'''
+        self._reset_players()
         canceled_order_dict = event.value
         if canceled_order_dict['pcode'] != event.participant.code:
             logger.error('A player attempted to cancel another player\'s order')
             return
 
-        exchange = self.exchanges.get(asset_name=canceled_order_dict['asset_name'])
+        exchange = self.get_exchange(canceled_order_dict['asset_name'])
         exchange.cancel_order(canceled_order_dict['order_id'])
 
-    def _on_accept_event(self, event):
-        '''handle an immediate accept message sent from the frontend'''
+    def _process_accept_event(self, event):
+        '''process an immediate accept message sent from the frontend'''
+        self._reset_players()
         accepted_order_dict = event.value
         sender_pcode = event.participant.code
-        player = self.get_player(sender_pcode)
-
-        if player and not player.check_available(not accepted_order_dict['is_bid'], accepted_order_dict['price'], accepted_order_dict['volume'], accepted_order_dict['asset_name']):
-            if accepted_order_dict['is_bid']:
-                if len(self.subsession.asset_names()) == 1:
-                    self._send_error(sender_pcode, 'Cannot accept order: insufficient available assets')
+        # like _process_enter_event, check and reserve the player's holdings before trading
+        with self._updating_holdings():
+            player = self.get_player(sender_pcode)
+            if player and not player.check_available(not accepted_order_dict['is_bid'], accepted_order_dict['price'], accepted_order_dict['remaining_volume'], accepted_order_dict['asset_name']):
+                if accepted_order_dict['is_bid']:
+                    if len(self.subsession.asset_names()) == 1:
+                        self._send_error(sender_pcode, 'Cannot accept order: insufficient available assets')
+                    else:
+                        self._send_error(sender_pcode, 'Cannot accept order: insufficient available amount of asset {}'.format(accepted_order_dict['asset_name']))
                 else:
-                    self._send_error(sender_pcode, 'Cannot accept order: insufficient available amount of asset {}'.format(accepted_order_dict['asset_name']))
-            else:
-                self._send_error(sender_pcode, 'Cannot accept order: insufficient available cash')
+                    self._send_error(sender_pcode, 'Cannot accept order: insufficient available cash')
+                return
+            self._reserve_holdings(player, not accepted_order_dict['is_bid'], accepted_order_dict['price'],
+                                   accepted_order_dict['remaining_volume'], accepted_order_dict['asset_name'])
+
+        with self._using_reservations():
+            exchange = self.get_exchange(accepted_order_dict['asset_name'])
+            exchange.accept_immediate(
+                accepted_order_dict['order_id'],
+                sender_pcode,
+            )
+
+    def _reserve_holdings(self, player, is_bid, price, volume, asset_name):
+        '''take the cash or assets needed for an order the current event is about to enter out of a player's available
+        holdings. this should be called inside an _updating_holdings block, right after checking them
+
+        the confirmations for the order then use up the reservation instead of changing the player's available holdings
+        again. whatever isn't used up when the event is done is given back, see _using_reservations'''
+        if player is None:
             return
-
-        exchange = self.exchanges.get(asset_name=accepted_order_dict['asset_name'])
-        exchange.accept_immediate(
-            accepted_order_dict['order_id'],
-            sender_pcode,
-        )
+        reservation = SimpleNamespace(pcode=player.participant.code, is_bid=is_bid, price=price, volume=volume, asset_name=asset_name)
+        player.update_holdings_available(reservation, False, volume)
+        self._holdings_changed(player)
+        if self._reservations is None:
+            self._reservations = []
+        self._reservations.append(reservation)
+
+    @contextmanager
+    def _using_reservations(self):
+        '''enter the orders holdings were reserved for inside this block. afterwards, any reserved holdings which weren't
+        used up by a confirmation, e.g. because the order was rejected or the exchange failed, are given back'''
+        try:
+            yield
+        finally:
+            reservations, self._reservations = self._reservations, None
+            unused = [r for r in reservations or () if r.volume > 0]
+            if unused:
+                with self._updating_holdings():
+                    for reservation in unused:
+                        player = self.get_player(reservation.pcode)
+                        player.update_holdings_available(reservation, True, reservation.volume)
+                        self._holdings_changed(player)
+
+    def _use_reservation(self, order, volume):
+        '''use up to `volume` of the holdings reserved for `order` by the current event. returns the volume used'''
+        used = 0
+        for reservation in self._reservations or ():
+            if used == volume:
+                break
+            if (reservation.pcode, reservation.is_bid, reservation.price, reservation.asset_name) != (order.pcode, order.is_bid, order.price, order.asset_name):
+                continue
+            amount = min(reservation.volume, volume - used)
+            reservation.volume -= amount
+            used += amount
+        return used
 
     def confirm_enter(self, order: Order):
         '''send an order entry confirmation to the frontend. this function is called
         by the exchange when an order is successfully entered'''
-        player = self.get_player(order.pcode)
-        if player:
-            player.update_holdings_available(order, False)
-            player.save()
-
-        self.send('confirm_enter', order.as_dict())
+        with self._updating_holdings():
+            payload = self._apply_enter(order)
+        self._send_message('confirm_enter', payload)
 
     def confirm_trade(self, trade: Trade):
         '''send a trade confirmation to the frontend. this function is called by the exchange when a trade occurs'''
+        with self._updating_holdings():
+            payload = self._apply_trade(trade)
+        self._send_message('confirm_trade', payload)
+    
+    def confirm_cancel(self, order: Order):
+        '''send an order cancel confirmation to the frontend. this function is called
+        by the exchange when an order is successfully canceled'''
+        with self._updating_holdings():
+            payload = self._apply_cancel(order)
+        self._send_message('confirm_cancel', payload)
+
+    def confirm_depth(self, asset_name, levels):
+        '''send the new volume at each changed price level of an exchange to the frontend. this function is called by the
+        exchange after its book changes if depth_messages is set. levels is a dict like the one from CDAExchange.get_depth,
+        but only has the levels which changed'''
+        self._send_message('depth', {
+            'asset_name': asset_name,
+            'bids': levels['bids'],
+            'asks': levels['asks'],
+        })
 
+    def confirm_batch(self, confirmations):
+        '''send several confirmations to the frontend in a single 'batch' message. this function is called by the exchange
+        when a batch of orders is entered or canceled at once.
+        param confirmations is a list of (channel, obj) tuples in the order they happened, where channel is one of
+        'confirm_enter', 'confirm_trade' or 'confirm_cancel' and obj is the Order or Trade that would be passed to
+        that channel's confirm method'''
+        apply_funcs = {
+            'confirm_enter': self._apply_enter,
+            'confirm_trade': self._apply_trade,
+            'confirm_cancel': self._apply_cancel,
+        }
+        with self._updating_holdings():
+            messages = [
+                {'channel': channel, 'payload': apply_funcs[channel](obj)}
+                for channel, obj in confirmations
+            ]
+        self._send_messages(messages)
+
+    def _apply_enter(self, order: Order):
+        '''update the submitting player's holdings for a newly entered order and return the confirm_enter payload'''
+        player = self.get_player(order.pcode)
+        if player:
+            # holdings reserved when the order was checked are already out of the player's available holdings
+            unreserved = order.remaining_volume - self._use_reservation(order, order.remaining_volume)
+            if unreserved:
+                player.update_holdings_available(order, False, unreserved)
+            self._holdings_changed(player)
+        return order.as_dict()
+
+    def _apply_trade(self, trade: Trade):
+        '''update the holdings of every player involved in a trade and return the confirm_trade payload'''
+        prefetch_related_objects([trade], 'fills__making_order')
         taking_player = self.get_player(trade.taking_order.pcode)
-        for making_order in trade.making_orders.all():
+        for fill in trade.fills.all():
+            making_order = fill.making_order
+            price = fill.price
+            volume = fill.volume
+            # the traded part of the taking order doesn't need the holdings reserved for it anymore
+            reserved = self._use_reservation(trade.taking_order, volume)
+            if reserved and taking_player:
+                taking_player.update_holdings_available(trade.taking_order, True, reserved)
             # edge case: making player and taking player are the same
             # just want to update available holdings and continue without making other changes
             if trade.taking_order.pcode == making_order.pcode:
-                taking_player.update_holdings_available(making_order, True)
+                taking_player.update_holdings_available(making_order, True, volume)
                 continue
 
             making_player = self.get_player(making_order.pcode)
-            volume = making_order.traded_volume
-            price = making_order.price
             if making_player:
-                # need to update making players' available cash and assets
+                # need to update making players' available cash and assets for the part of their order that traded
                 # since these were adjusted when their order was entered, they need to be adjusted back so they're not double counted
-                making_player.update_holdings_available(making_order, True)
-                making_player.update_holdings_trade(price, volume, making_order.is_bid, trade.exchange.asset_name)
-                making_player.save()
+                making_player.update_holdings_available(making_order, True, volume)
+                making_player.update_holdings_trade(price, volume, making_order.is_bid, fill.asset_name)
+                self._holdings_changed(making_player)
             if taking_player:
-                taking_player.update_holdings_trade(price, volume, trade.taking_order.is_bid, trade.exchange.asset_name)
-        if taking_player:
-            taking_player.save()
+                taking_player.update_holdings_trade(price, volume, trade.taking_order.is_bid, fill.asset_name)
+        self._holdings_changed(taking_player)
+        return trade.as_dict()
 
-        self.send('confirm_trade', trade.as_dict())
-    
-    def confirm_cancel(self, order: Order):
-        '''send an order cancel confirmation to the frontend. this function is called
-        by the exchange when an order is successfully canceled'''
+    def _apply_cancel(self, order: Order):
+        '''update the submitting player's holdings for a canceled order and return the confirm_cancel payload'''
         player = self.get_player(order.pcode)
         if player:
             player.update_holdings_available(order, True)
-            player.save()
-
-        self.send('confirm_cancel', order.as_dict())
+            self._holdings_changed(player)
+        return order.as_dict()
     
     def _send_error(self, pcode, message):
         '''send an error message to a player'''
-        self.send('error', {
+        self.send_to_participant(pcode, 'error', {
             'pcode': pcode,
             'message': message,
         })
 
+    def send_to_participant(self, pcode, channel, payload):
+        '''send a message to a single player instead of broadcasting it to the whole group. trader_state receives these
+        messages on its own websocket. use this for errors and other messages only one player needs to see'''
+        send_to_participant(pcode, channel, payload)
+
+    def get_message_schema(self):
+        '''get the schema the frontend needs to decode compact messages, or None if this group doesn't use them'''
+        if not self.compact_messages:
+            return None
+        return self._get_message_encoder().schema()
+
+    def _get_message_encoder(self):
+        '''get the CompactEncoder for this group, creating it if necessary. participant codes are numbered by id in group'''
+        key = (self._meta.label, self.pk)
+        encoder = _message_encoders.get(key)
+        if encoder is None:
+            players = sorted(self._get_players_by_pcode().items(), key=lambda item: item[1].id_in_group)
+            encoder = _message_encoders[key] = CompactEncoder(self.subsession.asset_names(), [pcode for pcode, _ in players])
+        return encoder
+
+    def get_stream_state(self):
+        '''get the sequence number of the most recent message sent for each of this group's exchanges, along with the id of
+        this server process's message streams. the frontend sends these back when it reconnects to catch up'''
+        _, rows = self._get_exchange_registry()
+        return {
+            'epoch': STREAM_EPOCH,
+            'seqs': {asset_name: self._get_event_ring(asset_name).last_seq for asset_name in rows},
+        }
+
+    def get_market_snapshot(self, exchange):
+        '''get lists of dicts for every active bid and ask and the most recent trades in an exchange (see snapshot_trades)
+
+        snapshots are shared by every player in the group and only rebuilt after the exchange changes, so the returned
+        dict must not be modified'''
+        key = (self._meta.label, self.pk, exchange.asset_name)
+        # the sequence number has to be read before the snapshot is built, see _on_resync_event
+        seq = self._get_event_ring(exchange.asset_name).last_seq
+        cached = _market_snapshots.get(key)
+        if cached is not None and cached[0] == seq:
+            return cached[1]
+
+        # when a whole group loads the page at once, only build the snapshot once
+        with _market_snapshot_locks.setdefault(key, threading.Lock()):
+            cached = _market_snapshots.get(key)
+            if cached is not None and cached[0] == seq:
+                return cached[1]
+            trades_qset = exchange._get_trades_qset()
+            if self.snapshot_trades is not None:
+                trades_qset = trades_qset[:self.snapshot_trades]
+            snapshot = {
+                'bids': [o.as_dict(exchange.asset_name) for o in exchange._get_bids_qset()],
+                'asks': [o.as_dict(exchange.asset_name) for o in exchange._get_asks_qset()],
+                'trades': [t.as_dict() for t in trades_qset],
+            }
+            if self.depth_messages:
+                snapshot['depth'] = exchange.get_depth()
+            _market_snapshots[key] = (seq, snapshot)
+            return snapshot
+
+    def player_left_market(self, player):
+        '''record that a player has left the market page. this is called by BaseMarketPage.before_next_page
+
+        once every player in the group has left, trading in this group is over, so everything this process has cached for it
+        is freed with release_market_state. returns True if trading is over in every group in this subsession'''
+        num_players = len(self.get_players())
+        num_groups = len(self.subsession.get_groups())
+        key = (self._meta.label, self.pk)
+        subsession_key = (self.subsession._meta.label, self.subsession.pk)
+        subsession_done = False
+        with _players_left_lock:
+            players_left = _players_left.setdefault(key, set())
+            players_left.add(player.pk)
+            group_done = len(players_left) >= num_players
+            if group_done:
+                del _players_left[key]
+                groups_done = _groups_done.setdefault(subsession_key, set())
+                groups_done.add(self.pk)
+                subsession_done = len(groups_done) >= num_groups
+                if subsession_done:
+                    del _groups_done[subsession_key]
+        if group_done:
+            self.release_market_state()
+        return subsession_done
+
+    def release_market_state(self):
+        '''free everything this process has cached for this group and its exchanges: the exchanges' order books, order
+        indexes, quotes and depth, snapshots, the recent messages kept for resyncs, and the group's exchange registry
+        entry, message encoder, outbox and holdings lock. this should only be called once trading in this group is over'''
+        _, rows = self._get_exchange_registry()
+        for asset_name in rows:
+            self.get_exchange(asset_name)._discard_cached_state()
+            key = (self._meta.label, self.pk, asset_name)
+            _market_snapshots.pop(key, None)
+            _market_snapshot_locks.pop(key, None)
+            discard_event_ring(key)
+        key = (self._meta.label, self.pk)
+        _exchange_registry.pop(key, None)
+        _message_encoders.pop(key, None)
+        _holdings_locks.pop(key, None)
+        discard_outbox(key)
+
+    def _get_event_ring(self, asset_name):
+        '''get the EventRing holding the recent messages for the exchange for `asset_name`'''
+        return get_event_ring((self._meta.label, self.pk, asset_name), self.resync_buffer_size)
+
+    def _sequence_messages(self, messages):
+        '''number each confirmation and depth update with the next sequence number for its exchange and remember it for resyncs'''
+        for message in messages:
+            if message['channel'] in ('confirm_enter', 'confirm_trade', 'confirm_cancel', 'depth'):
+                self._get_event_ring(message['payload']['asset_name']).append(message)
+
+    def _on_resync_event(self, event):
+        '''handle a resync message sent from the frontend when it (re)connects
+
+        the message has the stream epoch and the last sequence number the trader saw for each exchange. for each exchange
+        they're behind on, they're sent the messages they missed, or a snapshot of the exchange and their holdings if those
+        messages aren't kept anymore. replies are only sent to the trader who asked'''
+        pcode = event.participant.code
+        epoch = event.value['epoch']
+        for asset_name, seq in event.value['seqs'].items():
+            ring = self._get_event_ring(asset_name)
+            messages = ring.since(seq) if epoch == STREAM_EPOCH else None
+            if messages == []:
+                continue
+            if messages is not None:
+                if self.compact_messages:
+                    encoder = self._get_message_encoder()
+                    messages = [encoder.encode_message(m) for m in messages]
+                self.send_to_participant(pcode, 'resync', {
+                    'epoch': STREAM_EPOCH,
+                    'asset_name': asset_name,
+                    'messages': messages,
+                })
+                continue
+            try:
+                exchange = self.get_exchange(asset_name)
+            except ValueError:
+                logger.error('A player attempted to resync an invalid asset')
+                continue
+            player = self.get_player(pcode)
+            # read the sequence number before the snapshot so nothing sent in between is missed. messages which are
+            # already reflected in the snapshot might be resent, but the frontend ignores ones it's already seen
+            seq = ring.last_seq
+            self.send_to_participant(pcode, 'resync', {
+                'epoch': STREAM_EPOCH,
+                'asset_name': asset_name,
+                'seq': seq,
+                'snapshot': self.get_market_snapshot(exchange),
+                'holdings': {
+                    'settled_assets': player.settled_assets,
+                    'available_assets': player.available_assets,
+                    'settled_cash': player.settled_cash,
+                    'available_cash': player.available_cash,
+                } if player else None,
+            })
+
+    def _send_message(self, channel, payload):
+        '''send a message to the frontend. see _send_messages'''
+        self._send_messages([{'channel': channel, 'payload': payload}])
+
+    def _send_messages(self, messages):
+        '''send a list of {'channel': ..., 'payload': ...} messages to the frontend in order
+
+        if batch_messages is set, the messages are held until the end of the current event, or until batch_window is up,
+        and sent together with everything else sent in that time'''
+        if not messages:
+            return
+        self._sequence_messages(messages)
+        if self._outbox is not None:
+            self._outbox.extend(messages)
+        else:
+            self._release_messages(messages)
+
+    def _release_messages(self, messages):
+        '''send messages that aren't being held for the current event, either right away or after batch_window'''
+        if not messages:
+            return
+        if self.batch_messages and self.batch_window > 0:
+            get_outbox((self._meta.label, self.pk), self.batch_window / 1000).add(self, messages)
+        else:
+            self._send_batch(messages)
+
+    def _send_batch(self, messages):
+        '''send a list of messages right away, as a single 'batch' message if there's more than one'''
+        if self.compact_messages:
+            encoder = self._get_message_encoder()
+            messages = [encoder.encode_message(m) for m in messages]
+        if len(messages) == 1:
+            self.send(messages[0]['channel'], messages[0]['payload'])
+        else:
+            self.send('batch', messages)
+
 
 class Player(BasePlayer):
 
@@ -191,6 +789,117 @@ class Player(BasePlayer):
     settled_cash = models.IntegerField()
     available_cash = models.IntegerField()
 
+    holdings_fields = ['settled_assets', 'available_assets', 'settled_cash', 'available_cash']
+    '''the names of the fields which hold this player's cash and assets'''
+    cash_fields = ['settled_cash', 'available_cash']
+    '''the names of the fields in holdings_fields which hold an amount of cash'''
+    asset_fields = ['settled_assets', 'available_assets']
+    '''the names of the fields in holdings_fields which hold a dict mapping asset names to amounts'''
+
+    _saved_holdings = None
+    '''a copy of this player's holdings as of the last time they were loaded from or saved to the database.
+    this is used to work out which holdings have changed since then'''
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        player = super().from_db(db, field_names, values)
+        player._remember_holdings()
+        return player
+
+    def _remember_holdings(self):
+        '''record this player's current holdings as the ones that are saved in the database'''
+        self._saved_holdings = {
+            field: copy.deepcopy(getattr(self, field, None))
+            for field in self.holdings_fields
+        }
+
+    def get_holdings_updates(self):
+        '''get a dict of the update values needed to save this player's holdings, containing only the holdings that have
+        changed since they were last loaded or saved.
+
+        cash fields are updated with an F() increment of however much they changed by, so that concurrent changes to the same
+        player's cash don't overwrite each other. asset fields are only written if some asset amount changed, and are written
+        whole. see save_holdings for how concurrent changes to them are merged'''
+        if self._saved_holdings is None:
+            return {field: getattr(self, field) for field in self.holdings_fields}
+        updates = {}
+        for field in self.holdings_fields:
+            value = getattr(self, field)
+            saved_value = self._saved_holdings[field]
+            if field in self.cash_fields and value is not None and saved_value is not None:
+                if value != saved_value:
+                    updates[field] = F(field) + (value - saved_value)
+            elif value != saved_value:
+                updates[field] = value
+        return updates
+
+    @classmethod
+    def save_holdings(cls, players):
+        '''save the changed holdings of several players
+
+        players whose changes touch the same set of fields are saved together in a single UPDATE statement. asset dicts
+        can't be incremented in place like cash, so for players whose assets changed, their rows are locked and each asset
+        amount's change is applied to the amounts currently in the database. that way a concurrent trade in a different
+        asset, even in another process, isn't overwritten'''
+        with transaction.atomic():
+            cls._rebase_asset_changes(players)
+            cls._save_holdings_updates(players)
+
+    @classmethod
+    def _rebase_asset_changes(cls, players):
+        '''lock the rows of the players whose assets changed and apply each player's changes in asset amounts to the
+        amounts currently saved in the database, so that saving them doesn't undo anything saved since they were loaded.
+        this should be called inside a transaction'''
+        changed_players = {
+            player.pk: player for player in players
+            if player._saved_holdings is not None
+            and any(getattr(player, field) != player._saved_holdings[field] for field in cls.asset_fields)
+        }
+        if not changed_players:
+            return
+        rows = (cls._default_manager.select_for_update()
+                                    .filter(pk__in=changed_players)
+                                    .values_list('pk', *cls.asset_fields))
+        for pk, *db_values in rows:
+            player = changed_players[pk]
+            for field, db_value in zip(cls.asset_fields, db_values):
+                value = getattr(player, field)
+                saved_value = player._saved_holdings[field]
+                # nothing to merge if this player didn't change this field or nobody else did
+                if value == saved_value or db_value == saved_value:
+                    continue
+                if not (isinstance(value, dict) and isinstance(saved_value, dict) and isinstance(db_value, dict)):
+                    continue
+                merged = dict(db_value)
+                for asset_name in set(value) | set(saved_value):
+                    change = value.get(asset_name, 0) - saved_value.get(asset_name, 0)
+                    merged[asset_name] = merged.get(asset_name, 0) + change
+                setattr(player, field, merged)
+
+    @classmethod
+    def _save_holdings_updates(cls, players):
+        '''write the updates from get_holdings_updates for several players, grouped by the fields they change'''
+        players_by_fields = {}
+        for player in players:
+            updates = player.get_holdings_updates()
+            if updates:
+                players_by_fields.setdefault(tuple(sorted(updates)), []).append((player, updates))
+
+        for fields, player_updates in players_by_fields.items():
+            # bulk_update writes whatever is in each player's fields, so temporarily swap in the update values
+            current_values = []
+            for player, updates in player_updates:
+                current_values.append({field: getattr(player, field) for field in fields})
+                for field, update in updates.items():
+                    setattr(player, field, update)
+            try:
+                cls._default_manager.bulk_update([player for player, _ in player_updates], fields)
+            finally:
+                for (player, _), values in zip(player_updates, current_values):
+                    for field, value in values.items():
+                        setattr(player, field, value)
+                    player._remember_holdings()
+
     def asset_endowment(self):
         '''this method defines each player's initial endowment of each asset. in single-asset mode, this should return
         a single value for the single asset. in multiple-asset mode, this should return a dict mapping asset names to
@@ -202,31 +911,38 @@ class Player(BasePlayer):
         player's endowment of cash'''
         raise NotImplementedError
 
-    def set_endowments(self):
-        '''sets all of this player's cash and asset endowments'''
+    def set_endowments(self, save=True):
+        '''sets all of this player's cash and asset endowments. if save is false, the caller is responsible for saving this player
+
+        this can be overridden to set other fields as well. Subsession.set_endowments calls overrides with no arguments
+        and expects them to save the player'''
 
         asset_endowment = self.asset_endowment()
         if not isinstance(asset_endowment, dict):
             asset_endowment = { SINGLE_ASSET_NAME: asset_endowment }
 
         self.settled_assets = asset_endowment
-        self.available_assets = asset_endowment
+        self.available_assets = dict(asset_endowment)
 
         cash_endowment = self.cash_endowment()
         self.settled_cash = cash_endowment
         self.available_cash = cash_endowment
 
-        self.save()
+        if save:
+            self.save()
     
-    def update_holdings_available(self, order, removed):
+    def update_holdings_available(self, order, removed, volume=None):
         '''update this player's available holdings (cash or assets) when they enter or remove an order.
         param order is the changed order belonging to this player.
-        param removed is true when the changed order was removed and false when the changed order was added'''
+        param removed is true when the changed order was removed and false when the changed order was added.
+        param volume is the amount of the order that was added or removed, defaulting to its remaining volume'''
+        if volume is None:
+            volume = order.remaining_volume
         sign = 1 if removed else -1
         if order.is_bid:
-            self.available_cash += order.price * order.volume * sign
+            self.available_cash += order.price * volume * sign
         else:
-            self.available_assets[order.exchange.asset_name] += order.volume * sign
+            self.available_assets[order.asset_name] += volume * sign
 
     def update_holdings_trade(self, price, volume, is_bid, asset_name):
         '''update this player's holdings (cash and assets) after a trade occurs.
@@ -252,6 +968,17 @@ class Player(BasePlayer):
             return False
         return True
 
+    def check_available_orders(self, orders, asset_name):
+        '''check whether this player has enough available holdings to enter every order in `orders` at once.
+        param orders is a list of dicts with the keys 'price', 'volume' and 'is_bid', all for the asset `asset_name`'''
+        bid_cash = sum(o['price'] * o['volume'] for o in orders if o['is_bid'])
+        ask_volume = sum(o['volume'] for o in orders if not o['is_bid'])
+        if bid_cash and self.available_cash < bid_cash:
+            return False
+        if ask_volume and self.available_assets[asset_name] < ask_volume:
+            return False
+        return True
+
     # jsonfield doesn't work correctly with save-the-change, it needs this hack
     # for more info see https://github.com/Leeps-Lab/otree-redwood/blob/master/otree_redwood/models.py#L167
     def save(self, *args, **kwargs):
@@ -263,3 +990,5 @@ class Player(BasePlayer):
                 if isinstance(field, JSONField) and (update_fields is None or field.attname in update_fields):
                     json_fields[field.attname] = getattr(self, field.attname)
             self.__class__._default_manager.filter(pk=self.pk).update(**json_fields)
+            if update_fields is None:
+                self._remember_holdings()
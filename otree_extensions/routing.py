@@ -0,0 +1,6 @@
+from django.conf.urls import url
+from otree_markets.consumers import ParticipantConsumer
+
+websocket_routes = [
+    url(ParticipantConsumer.url_pattern, ParticipantConsumer),
+]
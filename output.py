@@ -1,9 +1,38 @@
 from .models import Group as MarketGroup
-from .exchange.base import OrderStatusEnum
+from .exchange.base import Order, Fill, OrderStatusEnum
+from .export_worker import init_export_worker, run_group_export
 
+from django.contrib.contenttypes.models import ContentType
+
+from concurrent.futures import ProcessPoolExecutor
+from importlib import import_module
+import multiprocessing
 import json
 import datetime
 import csv
+import io
+
+
+def _buffered(pieces, size=1 << 16):
+    '''join the strings from the iterable `pieces` into chunks of at least `size` characters'''
+    buf = []
+    buf_len = 0
+    for piece in pieces:
+        buf.append(piece)
+        buf_len += len(piece)
+        if buf_len >= size:
+            yield ''.join(buf)
+            buf = []
+            buf_len = 0
+    if buf:
+        yield ''.join(buf)
+
+
+class _Echo():
+    '''a file-like object which just returns what's written to it, so csv.writer can be used to format single rows'''
+
+    def write(self, value):
+        return value
 
 
 class BaseMarketOutputGenerator():
@@ -17,13 +46,28 @@ class BaseMarketOutputGenerator():
     bottom of output.py and it'll be included as a download option on the data export screen.
 
     note that if you specify 'output_generators' in your output.py, the default JSON output generator will not be included. you can add
-    it back by importing DefaultJSONMarketOutputGenerator from this file and including it in your list.
+    it back by importing StreamingJSONMarketOutputGenerator (or DefaultJSONMarketOutputGenerator, which produces the same output
+    without streaming) from this file and including it in your list.
     '''
 
     download_link_text = 'get output'
     '''the text that will be shown on the download link for this output format
     '''
 
+    streaming = False
+    '''if this is True, the output is sent to the browser piece by piece as it's generated using iter_output instead
+    of write_output. this keeps memory use down for very large outputs
+    '''
+
+    cache_output = False
+    '''if this is True, the output is saved to disk the first time it's downloaded and the saved file is sent for later
+    downloads, until any orders or fills in the session change. streaming output is still streamed the first time while
+    it's saved. only set this if the output only depends on the session's orders, trades and fills. see export_cache.py
+
+    this is off in every base class meant to be subclassed. the built-in orders, fills and npz outputs set it, so
+    subclasses of those which add any other data should set it back to False
+    '''
+
     def __init__(self, session):
         self.session = session
 
@@ -51,6 +95,46 @@ class BaseMarketOutputGenerator():
         '''
         raise NotImplementedError()
 
+    def iter_output(self):
+        '''this method is used instead of write_output when streaming is True
+
+        it should be a generator which yields the output data as a series of strings or bytes
+        '''
+        raise NotImplementedError()
+
+    parallel_workers = None
+    '''set this to a number of worker processes to generate the output for each group in parallel in that many processes.
+    each process has its own database connection. the results are still output in the same order as when they're generated
+    one at a time. None means groups are processed one at a time in the web server process
+    '''
+
+    def iter_market_groups(self):
+        '''a generator which yields every markets group in this session, ordered by round number then id in subsession'''
+        for subsession in self.session.get_subsessions():
+            for group in subsession.get_groups():
+                if isinstance(group, MarketGroup):
+                    yield group
+
+    def map_market_groups(self, method_name):
+        '''a generator which calls the method of this object named `method_name` with every markets group in this session and
+        yields the results in the same order as iter_market_groups
+
+        if parallel_workers is set, the groups are divided between a pool of worker processes. in that case the output
+        generator is recreated in each worker from its class and session, so it shouldn't rely on any other state. results
+        that are generators are turned into lists so they can be sent back from the workers
+        '''
+        if not self.parallel_workers:
+            for group in self.iter_market_groups():
+                yield getattr(self, method_name)(group)
+            return
+
+        tasks = [(type(self), self.session.pk, group._meta.label, group.pk, method_name) for group in self.iter_market_groups()]
+        # the web server has other threads running, so workers are spawned fresh instead of forked from it. they set up
+        # django and open their own database connections
+        mp_context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(self.parallel_workers, mp_context=mp_context, initializer=init_export_worker) as pool:
+            yield from pool.map(run_group_export, tasks)
+
 
 class BaseCSVMarketOutputGenerator(BaseMarketOutputGenerator):
     '''this class is a base output generator which simplifies the creation of CSV output files
@@ -74,11 +158,14 @@ class BaseCSVMarketOutputGenerator(BaseMarketOutputGenerator):
     def write_output(self, response):
         writer = csv.writer(response)
         writer.writerow(self.get_header())
-        for subsession in self.session.get_subsessions():
-            for group in subsession.get_groups():
-                if not isinstance(group, MarketGroup):
-                    continue
-                writer.writerows(self.get_group_output(group))
+        for group_output in self.map_market_groups('get_group_output'):
+            writer.writerows(group_output)
+
+    def iter_output(self):
+        writer = csv.writer(_Echo())
+        rows = (writer.writerow(row) for group_output in self.map_market_groups('get_group_output') for row in group_output)
+        yield writer.writerow(self.get_header())
+        yield from _buffered(rows)
 
     def get_header(self):
         '''this method should return a list of strings which will form the csv's header
@@ -94,6 +181,115 @@ class BaseCSVMarketOutputGenerator(BaseMarketOutputGenerator):
         raise NotImplementedError()
 
 
+class BaseRowsCSVMarketOutputGenerator(BaseCSVMarketOutputGenerator):
+    '''this class is a base for the built-in CSV output generators, which export one row per order or fill
+
+    rows are read with chunked values_list queries instead of loading model objects, and are streamed to the browser,
+    so these are fast and use little memory even for sessions with millions of rows.
+    '''
+
+    streaming = True
+
+    chunk_size = 5000
+    '''the number of rows fetched from the database at a time'''
+
+    table_name = None
+    '''the name of the data in this output, used in the filename'''
+
+    fields = ()
+    '''the fields read from the database for each row, passed to format_row'''
+
+    group_header = ['round_number', 'id_in_subsession', 'asset_name']
+    '''the header of the columns at the start of every row identifying the group and asset'''
+
+    def get_filename(self):
+        return '{} {} - session {} (accessed {}).csv'.format(
+            self.session.config['display_name'],
+            self.table_name,
+            self.session.code,
+            datetime.date.today().isoformat()
+        )
+
+    def get_group_output(self, group):
+        exchange_assets = dict(group.exchanges.values_list('id', 'asset_name'))
+        if not exchange_assets:
+            return
+        start_time = group.get_start_time()
+        group_values = (group.round_number, group.id_in_subsession)
+        qset = (self.get_queryset()
+                    .filter(content_type=ContentType.objects.get_for_model(group.exchanges.model),
+                            object_id__in=exchange_assets)
+                    .values_list('object_id', *self.fields)
+                    .iterator(chunk_size=self.chunk_size))
+        for exchange_id, *values in qset:
+            yield (*group_values, exchange_assets[exchange_id], *self.format_row(values, start_time))
+
+    def get_queryset(self):
+        '''this method should return a queryset of every row of this output's model, in the order they should be output'''
+        raise NotImplementedError()
+
+    def format_row(self, values, start_time):
+        '''this method should return a row of the output given a list of the values of `fields` for a single row'''
+        raise NotImplementedError()
+
+
+class OrdersCSVMarketOutputGenerator(BaseRowsCSVMarketOutputGenerator):
+    '''this class outputs a CSV with one row for every order in the session
+
+    times are in seconds relative to the start of the round
+    '''
+
+    download_link_text = 'get orders csv'
+    cache_output = True
+    table_name = 'Orders'
+    fields = ('id', 'pcode', 'is_bid', 'price', 'volume', 'traded_volume', 'status', 'timestamp', 'time_inactive')
+
+    def get_header(self):
+        return self.group_header + ['order_id', 'pcode', 'is_bid', 'price', 'volume', 'traded_volume', 'status',
+                                    'time_entered', 'time_inactive']
+
+    def get_queryset(self):
+        return Order.objects.order_by('timestamp', 'id')
+
+    def format_row(self, values, start_time):
+        order_id, pcode, is_bid, price, volume, traded_volume, status, timestamp, time_inactive = values
+        return (
+            order_id,
+            pcode,
+            is_bid,
+            price,
+            volume,
+            traded_volume,
+            OrderStatusEnum(status).name,
+            (timestamp - start_time).total_seconds(),
+            (time_inactive - start_time).total_seconds() if time_inactive else None,
+        )
+
+
+class FillsCSVMarketOutputGenerator(BaseRowsCSVMarketOutputGenerator):
+    '''this class outputs a CSV with one row for every fill in the session, i.e. one row for each making order
+    traded with in each trade
+
+    times are in seconds relative to the start of the round
+    '''
+
+    download_link_text = 'get fills csv'
+    cache_output = True
+    table_name = 'Fills'
+    fields = ('trade_id', 'timestamp', 'taking_order_id', 'taking_order__pcode', 'taking_order__is_bid', 'making_order_id',
+              'making_order__pcode', 'price', 'volume')
+
+    def get_header(self):
+        return self.group_header + ['trade_id', 'timestamp', 'taking_order_id', 'taking_pcode', 'taking_is_bid',
+                                    'making_order_id', 'making_pcode', 'price', 'volume']
+
+    def get_queryset(self):
+        return Fill.objects.order_by('timestamp', 'trade_id', 'id')
+
+    def format_row(self, values, start_time):
+        return (values[0], (values[1] - start_time).total_seconds(), *values[2:])
+
+
 class BaseJSONMarketOutputGenerator(BaseMarketOutputGenerator):
     '''this class is a base output generator which simplifies the creation of JSON output files
 
@@ -115,14 +311,7 @@ class BaseJSONMarketOutputGenerator(BaseMarketOutputGenerator):
         )
 
     def write_output(self, response):
-        group_data = []
-        for subsession in self.session.get_subsessions():
-            for group in subsession.get_groups():
-                if not isinstance(group, MarketGroup):
-                    continue
-                data = self.get_group_data(group)
-                if data is not None:
-                    group_data.append(data)
+        group_data = [data for data in self.map_market_groups('get_group_data') if data is not None]
 
         json.dump(group_data, response)
 
@@ -138,8 +327,8 @@ class DefaultJSONMarketOutputGenerator(BaseJSONMarketOutputGenerator):
     '''this class is the default output generator
 
     it returns dicts with the round number and id for each group, along with lists of all the orders
-    and trades which were created during that group's trading period. all order and trade timestamps
-    are in seconds relative to the start of the round.
+    and trades which were created during that group's trading period. each trade includes the price and volume
+    traded with each of its making orders. all order and trade timestamps are in seconds relative to the start of the round.
     '''
 
     def order_to_output_dict(self, order, start_time):
@@ -156,17 +345,26 @@ class DefaultJSONMarketOutputGenerator(BaseJSONMarketOutputGenerator):
         }
     
     def trade_to_output_dict(self, trade, start_time):
+        fills = trade.fills.all()
         return {
             'timestamp': (trade.timestamp - start_time).total_seconds(),
-            'taking_order_id': trade.taking_order.id,
-            'making_order_ids': [ o.id for o in trade.making_orders.all() ],
+            'taking_order_id': trade.taking_order_id,
+            'making_order_ids': [ f.making_order_id for f in fills ],
+            'fills': [
+                {
+                    'making_order_id': f.making_order_id,
+                    'price': f.price,
+                    'volume': f.volume,
+                }
+                for f in fills
+            ],
         }
     
     def get_group_data(self, group):
         start_time = group.get_start_time()
 
         exchange_data = []
-        exchange_query = group.exchanges.all().prefetch_related('orders', 'trades')
+        exchange_query = group.exchanges.all().prefetch_related('orders', 'trades__fills')
         for exchange in exchange_query:
             orders = [self.order_to_output_dict(e, start_time) for e in exchange.orders.all()]
             trades = [self.trade_to_output_dict(e, start_time) for e in exchange.trades.all()]
@@ -182,3 +380,259 @@ class DefaultJSONMarketOutputGenerator(BaseJSONMarketOutputGenerator):
             'id_in_subsession': group.id_in_subsession,
             'exchange_data': exchange_data,
         }
+
+
+class BaseStreamingJSONMarketOutputGenerator(BaseJSONMarketOutputGenerator):
+    '''this class is a base output generator for JSON output files which are too big to build in memory all at once
+
+    to use it, subclass it in output.py and fill out 'iter_group_json', then add it to output_generators as described above.
+    like BaseJSONMarketOutputGenerator, the output is a JSON list with an entry for each group, but each group's entry is
+    generated piece by piece and sent to the browser as it's generated, so memory use stays the same no matter how big
+    the session is.
+    '''
+
+    streaming = True
+
+    chunk_size = 2000
+    '''the number of rows fetched from the database at a time'''
+
+    def write_output(self, response):
+        for chunk in self.iter_output():
+            response.write(chunk)
+
+    def iter_output(self):
+        return _buffered(self._iter_json())
+
+    def _iter_json(self):
+        yield '['
+        first = True
+        for group in self.iter_market_groups():
+            pieces = iter(self.iter_group_json(group))
+            first_piece = next(pieces, None)
+            if first_piece is None:
+                continue
+            if not first:
+                yield ','
+            first = False
+            yield first_piece
+            yield from pieces
+        yield ']'
+
+    def iter_group_json(self, group):
+        '''this method should be a generator which yields strings that together make up the JSON for a single group.
+
+        if it doesn't yield anything, the group is left out of the output list
+        '''
+        raise NotImplementedError()
+
+    def iter_json_list(self, items):
+        '''a generator which yields the JSON for a list of the JSON serializable objects from the iterable `items`'''
+        yield '['
+        for i, item in enumerate(items):
+            if i > 0:
+                yield ','
+            yield json.dumps(item)
+        yield ']'
+
+
+class StreamingJSONMarketOutputGenerator(BaseStreamingJSONMarketOutputGenerator):
+    '''this class streams the same output as DefaultJSONMarketOutputGenerator
+
+    orders, trades and fills are read with values_list queries in chunks instead of being loaded as model objects, so
+    this is much faster and uses much less memory for long sessions.
+    '''
+
+    order_fields = ('timestamp', 'price', 'volume', 'is_bid', 'pcode', 'traded_volume', 'id', 'status', 'time_inactive')
+
+    def iter_group_json(self, group):
+        exchanges = list(group.exchanges.order_by('id'))
+        if not exchanges:
+            return
+        start_time = group.get_start_time()
+
+        yield '{{"round_number": {}, "id_in_subsession": {}, "exchange_data": ['.format(
+            json.dumps(group.round_number), json.dumps(group.id_in_subsession))
+        for i, exchange in enumerate(exchanges):
+            if i > 0:
+                yield ','
+            yield '{{"asset_name": {}, "orders": '.format(json.dumps(exchange.asset_name))
+            yield from self.iter_json_list(self._iter_order_dicts(exchange, start_time))
+            yield ', "trades": '
+            yield from self.iter_json_list(self._iter_trade_dicts(exchange, start_time))
+            yield '}'
+        yield ']}'
+
+    def _iter_order_dicts(self, exchange, start_time):
+        rows = (exchange.orders.order_by('timestamp', 'id')
+                               .values_list(*self.order_fields)
+                               .iterator(chunk_size=self.chunk_size))
+        for timestamp, price, volume, is_bid, pcode, traded_volume, order_id, status, time_inactive in rows:
+            yield {
+                'time_entered': (timestamp - start_time).total_seconds(),
+                'price': price,
+                'volume': volume,
+                'is_bid': is_bid,
+                'pcode': pcode,
+                'traded_volume': traded_volume,
+                'id': order_id,
+                'status': OrderStatusEnum(status).name,
+                'time_inactive': (time_inactive - start_time).total_seconds() if time_inactive else None,
+            }
+
+    def _iter_trade_dicts(self, exchange, start_time):
+        trades = (exchange.trades.order_by('timestamp', 'id')
+                                 .values_list('id', 'timestamp', 'taking_order_id')
+                                 .iterator(chunk_size=self.chunk_size))
+        # a fill has the same timestamp as its trade, so sorting fills this way puts them in the same order as the trades.
+        # that way each trade's fills can be read off the front of the fills query as the trades are generated
+        fills = (exchange.fills.order_by('timestamp', 'trade_id', 'id')
+                               .values_list('trade_id', 'making_order_id', 'price', 'volume')
+                               .iterator(chunk_size=self.chunk_size))
+        next_fill = next(fills, None)
+        for trade_id, timestamp, taking_order_id in trades:
+            trade_fills = []
+            while next_fill is not None and next_fill[0] == trade_id:
+                trade_fills.append(next_fill)
+                next_fill = next(fills, None)
+            yield {
+                'timestamp': (timestamp - start_time).total_seconds(),
+                'taking_order_id': taking_order_id,
+                'making_order_ids': [f[1] for f in trade_fills],
+                'fills': [
+                    {
+                        'making_order_id': making_order_id,
+                        'price': price,
+                        'volume': volume,
+                    }
+                    for _, making_order_id, price, volume in trade_fills
+                ],
+            }
+
+
+class NumpyMarketOutputGenerator(BaseMarketOutputGenerator):
+    '''this class outputs every exchange's orders and fills as typed column arrays in a single numpy .npz archive
+
+    this requires numpy to be installed. load the output with numpy.load. each array in the archive is named
+    '<app name>_r<round number>_g<id in subsession>_<asset name>_<orders or fills>_<column>'. order columns are:
+        id, time_entered, time_inactive (int64), price, volume, traded_volume (int32), is_bid (bool), status (uint8),
+        pcode (int32)
+    fill columns are:
+        trade_id, taking_order_id, making_order_id (int64), timestamp (int64), price, volume (int32), taking_is_bid (bool),
+        taking_pcode, making_pcode (int32)
+
+    times are integer microseconds relative to the start of the round, and a time_inactive of -1 means the order was
+    still active. a traded_volume of 0 means nothing traded. statuses are OrderStatusEnum values, and the archive's
+    'status_names' array has the name of each status at the index of its value. participant codes are indices into
+    the archive's 'pcodes' array.
+    '''
+
+    download_link_text = 'get npz'
+    cache_output = True
+
+    chunk_size = 5000
+    '''the number of rows fetched from the database at a time'''
+
+    order_fields = ('id', 'timestamp', 'time_inactive', 'price', 'volume', 'traded_volume', 'is_bid', 'status', 'pcode')
+    fill_fields = ('trade_id', 'taking_order_id', 'making_order_id', 'timestamp', 'price', 'volume', 'taking_order__is_bid',
+                   'taking_order__pcode', 'making_order__pcode')
+
+    def get_mime_type(self):
+        return 'application/octet-stream'
+
+    def get_filename(self):
+        return '{} Market Data - session {} (accessed {}).npz'.format(
+            self.session.config['display_name'],
+            self.session.code,
+            datetime.date.today().isoformat()
+        )
+
+    def write_output(self, response):
+        try:
+            import numpy as np
+        except ImportError as e:
+            raise ImportError('numpy is required for .npz output. install it with "pip install numpy"') from e
+
+        pcode_ids = {}
+        arrays = {}
+        for group in self.iter_market_groups():
+            start_time = group.get_start_time()
+            for exchange in group.exchanges.order_by('id'):
+                prefix = f'{group._meta.app_label}_r{group.round_number}_g{group.id_in_subsession}_{exchange.asset_name}'
+                arrays.update(self._get_order_arrays(np, exchange, start_time, pcode_ids, prefix + '_orders_'))
+                arrays.update(self._get_fill_arrays(np, exchange, start_time, pcode_ids, prefix + '_fills_'))
+
+        arrays['pcodes'] = np.array(list(pcode_ids), dtype=str)
+        status_names = [''] * (max(OrderStatusEnum) + 1)
+        for status in OrderStatusEnum:
+            status_names[status] = status.name
+        arrays['status_names'] = np.array(status_names, dtype=str)
+
+        # zip files can't be written to an unseekable stream efficiently, so build the archive in memory first
+        buf = io.BytesIO()
+        np.savez(buf, **arrays)
+        response.write(buf.getvalue())
+
+    def _get_order_arrays(self, np, exchange, start_time, pcode_ids, prefix):
+        columns = [[] for _ in self.order_fields]
+        rows = exchange.orders.order_by('timestamp', 'id').values_list(*self.order_fields).iterator(chunk_size=self.chunk_size)
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        ids, timestamps, times_inactive, prices, volumes, traded_volumes, is_bids, statuses, pcodes = columns
+        return {
+            prefix + 'id': np.array(ids, dtype=np.int64),
+            prefix + 'time_entered': np.array([_micros(t, start_time) for t in timestamps], dtype=np.int64),
+            prefix + 'time_inactive': np.array([_micros(t, start_time) if t else -1 for t in times_inactive], dtype=np.int64),
+            prefix + 'price': np.array(prices, dtype=np.int32),
+            prefix + 'volume': np.array(volumes, dtype=np.int32),
+            prefix + 'traded_volume': np.array([v or 0 for v in traded_volumes], dtype=np.int32),
+            prefix + 'is_bid': np.array(is_bids, dtype=bool),
+            prefix + 'status': np.array(statuses, dtype=np.uint8),
+            prefix + 'pcode': np.array([pcode_ids.setdefault(p, len(pcode_ids)) for p in pcodes], dtype=np.int32),
+        }
+
+    def _get_fill_arrays(self, np, exchange, start_time, pcode_ids, prefix):
+        columns = [[] for _ in self.fill_fields]
+        rows = (exchange.fills.order_by('timestamp', 'trade_id', 'id')
+                              .values_list(*self.fill_fields)
+                              .iterator(chunk_size=self.chunk_size))
+        for row in rows:
+            for column, value in zip(columns, row):
+                column.append(value)
+        trade_ids, taking_ids, making_ids, timestamps, prices, volumes, taking_is_bids, taking_pcodes, making_pcodes = columns
+        return {
+            prefix + 'trade_id': np.array(trade_ids, dtype=np.int64),
+            prefix + 'taking_order_id': np.array(taking_ids, dtype=np.int64),
+            prefix + 'making_order_id': np.array(making_ids, dtype=np.int64),
+            prefix + 'timestamp': np.array([_micros(t, start_time) for t in timestamps], dtype=np.int64),
+            prefix + 'price': np.array(prices, dtype=np.int32),
+            prefix + 'volume': np.array(volumes, dtype=np.int32),
+            prefix + 'taking_is_bid': np.array(taking_is_bids, dtype=bool),
+            prefix + 'taking_pcode': np.array([pcode_ids.setdefault(p, len(pcode_ids)) for p in taking_pcodes], dtype=np.int32),
+            prefix + 'making_pcode': np.array([pcode_ids.setdefault(p, len(pcode_ids)) for p in making_pcodes], dtype=np.int32),
+        }
+
+
+def _micros(time, start_time):
+    '''get the number of whole microseconds from `start_time` to `time`'''
+    delta = time - start_time
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def get_output_generators(session_config):
+    '''get the list of output generator classes for a session config
+
+    these are collected from the 'output_generators' list in each app's output.py. if no output generators are provided by
+    any app, just include the default json generator. the streaming version is used since it produces the same output
+    without loading the whole session into memory
+    '''
+    output_generators = []
+    for app_name in session_config['app_sequence']:
+        try:
+            output_module = import_module(f'{app_name}.output')
+            output_generators.extend(output_module.output_generators)
+        except (ImportError, AttributeError):
+            continue
+    if not output_generators:
+        output_generators.append(StreamingJSONMarketOutputGenerator)
+    return output_generators
@@ -1,20 +1,27 @@
 from ._builtin import Page
+from otree.common import get_models_module
 import json
 
+from .models import Group as MarketGroup
+from .export_cache import prebuild_exports
+
 class BaseMarketPage(Page):
 
     def get_context_data(self, *args, **kwargs):
         context = super().get_context_data(*args, **kwargs)
+        # the stream state has to be read before the market state, see Group._on_resync_event
+        stream_state = self.group.get_stream_state()
         bids = []
         asks = []
         trades = []
-        for exchange in self.group.exchanges.all():
-            for bid_order in exchange._get_bids_qset():
-                bids.append(bid_order.as_dict())
-            for ask_order in exchange._get_asks_qset():
-                asks.append(ask_order.as_dict())
-            for trade in exchange._get_trades_qset():
-                trades.append(trade.as_dict())
+        depth = {}
+        for exchange in self.group.get_exchanges():
+            snapshot = self.group.get_market_snapshot(exchange)
+            bids.extend(snapshot['bids'])
+            asks.extend(snapshot['asks'])
+            trades.extend(snapshot['trades'])
+            if 'depth' in snapshot:
+                depth[exchange.asset_name] = snapshot['depth']
         remaining_time = self.group.get_remaining_time()
         context.update({
             'trader_state': {
@@ -26,6 +33,25 @@ class BaseMarketPage(Page):
                 'settled_assets': json.dumps(self.player.settled_assets),
                 'available_cash': self.player.available_cash,
                 'settled_cash': self.player.settled_cash,
+                'compact_schema': json.dumps(self.group.get_message_schema()),
+                'stream_state': json.dumps(stream_state),
+                'depth': json.dumps(depth),
             }
         })
         return context
+
+    def before_next_page(self):
+        trading_over = self.group.player_left_market(self.player)
+        # once trading is over in every group in the session's last markets round, start building the session's exports
+        # so they're ready to download
+        if trading_over and self.group.prebuild_exports and self._is_last_markets_round():
+            prebuild_exports(self.session)
+
+    def _is_last_markets_round(self):
+        '''returns true if this is the last round of the last app in the session which uses oTree Markets'''
+        markets_apps = [
+            app_name for app_name in self.session.config['app_sequence']
+            if issubclass(get_models_module(app_name).Group, MarketGroup)
+        ]
+        app_name = self.player._meta.app_label
+        return app_name == markets_apps[-1] and self.round_number == get_models_module(app_name).Constants.num_rounds
@@ -0,0 +1,30 @@
+from django.db import models
+from django.utils import timezone
+
+
+class MarketSessionIndex(models.Model):
+    '''this model records the config name of each markets session, so sessions can be looked up by config without
+    loading and unpickling every session's config
+
+    rows are created when a markets session is created. sessions created before this model existed can be added with
+    the index_market_sessions management command.
+    '''
+
+    class Meta:
+        app_label = 'otree_markets'
+        index_together = ('config_name', 'created')
+
+    session = models.OneToOneField('otree.Session', primary_key=True, related_name='+', on_delete=models.CASCADE)
+    '''the indexed session'''
+    config_name = models.CharField(max_length=255)
+    '''the name of the session's config'''
+    created = models.DateTimeField(null=True)
+    '''the time the session was created. null for sessions added by index_market_sessions'''
+
+    @classmethod
+    def index_session(cls, session):
+        '''add a session to the index if it isn't already there'''
+        cls.objects.get_or_create(session=session, defaults={
+            'config_name': session.config['name'],
+            'created': timezone.now(),
+        })
@@ -18,7 +18,7 @@ export class OrderList extends PolymerElement {
             displayFormat: {
                 type: Object,
                 value: function() {
-                    return order => `${order.volume} @ $${order.price}`;
+                    return order => `${order.remaining_volume} @ $${order.price}`;
                 },
             },
         };
@@ -33,6 +33,13 @@ export class TraderState extends PolymerElement {
                 value: TRADER_STATE.trades,
                 notify: true,
             },
+            // dict mapping asset names to the aggregated depth of that asset's book, if the group has depth_messages set
+            // each value has the keys bids and asks, which are arrays of [price, volume] pairs in priority order
+            depth: {
+                type: Object,
+                value: TRADER_STATE.depth,
+                notify: true,
+            },
             // dict mapping asset names to this player's settled amount of that asset
             settledAssetsDict: {
                 type: Object,
@@ -94,6 +101,18 @@ export class TraderState extends PolymerElement {
                 id="accept_chan"
                 channel="accept"
             ></redwood-channel>
+            <redwood-channel
+                id="enter_batch_chan"
+                channel="enter_batch"
+            ></redwood-channel>
+            <redwood-channel
+                id="cancel_all_chan"
+                channel="cancel_all"
+            ></redwood-channel>
+            <redwood-channel
+                id="resync_chan"
+                channel="resync"
+            ></redwood-channel>
 
             <!-- inbound channels -->
             <redwood-channel
@@ -109,8 +128,12 @@ export class TraderState extends PolymerElement {
                 on-event="_handle_confirm_cancel"
             ></redwood-channel>
             <redwood-channel
-                channel="error"
-                on-event="_handle_error"
+                channel="depth"
+                on-event="_handle_depth"
+            ></redwood-channel>
+            <redwood-channel
+                channel="batch"
+                on-event="_handle_batch"
             ></redwood-channel>
             <redwood-channel
                 channel="state"
@@ -126,6 +149,16 @@ export class TraderState extends PolymerElement {
     ready() {
         super.ready();
         this.pcode = this.$.constants.participantCode;
+        // schema used to decode compact messages, or null if this group doesn't send them
+        this.compactSchema = TRADER_STATE.compact_schema;
+        // id of the backend's message stream and the sequence number of the last message handled for each asset
+        // these are sent back to the backend when reconnecting so it can resend just the messages that were missed
+        this._streamEpoch = TRADER_STATE.stream_state.epoch;
+        this._seqs = Object.assign({}, TRADER_STATE.stream_state.seqs);
+        this._lastResyncRequest = null;
+        // timeout for a resync request waiting out the rate limit, or null if there isn't one
+        this._pendingResync = null;
+        this._connect_participant_socket();
 
         // dynamically make single-asset properties computed only when in single-asset mode
         // that way these properties will just be null when using multiple assets. might prevent some confusion
@@ -156,9 +189,31 @@ export class TraderState extends PolymerElement {
         this.$.accept_chan.send(order);
     }
 
+    // call this method to enter several orders for one asset in a single message
+    // orders is an array of objects with the fields price, volume and is_bid. if the player can't afford all of them,
+    // none are entered
+    enter_orders(orders, asset_name=null) {
+        this.$.enter_batch_chan.send({
+            orders: orders.map(o => ({price: o.price, volume: o.volume, is_bid: o.is_bid})),
+            asset_name: asset_name,
+        });
+    }
+
+    // call this method to cancel all of this player's orders for one asset
+    // if side is 'bid' or 'ask', only this player's bids or asks are canceled
+    cancel_all(asset_name=null, side=null) {
+        this.$.cancel_all_chan.send({
+            asset_name: asset_name,
+            side: side,
+        });
+    }
+
     // handle an incoming order entry confirmation
     _handle_confirm_enter(event) {
-        const order = event.detail.payload;
+        const order = this._decode_order(event.detail.payload);
+        // orders can already be in the book if this message was resent after a snapshot
+        if (!this._check_seq(order.asset_name, order.seq) || this._find_order(order, false) >= 0)
+            return;
         if (order.is_bid) {
             this._insert_bid(order);
         }
@@ -175,18 +230,26 @@ export class TraderState extends PolymerElement {
 
     // handle an incoming trade confirmation
     _handle_confirm_trade(event) {
-        const trade = event.detail.payload;
+        const trade = this._decode_trade(event.detail.payload);
+        // trades can already be in the trades list if this message was resent after a snapshot
+        if (!this._check_seq(trade.asset_name, trade.seq) || this.trades.some(t => t.taking_order.order_id == trade.taking_order.order_id))
+            return;
         // iterate through making orders from this trade. if a making order is yours or the taking order is yours,
         // update your cash and assets appropriately
+        // traded_volume on each making order is the amount traded in this trade, and remaining_volume is what's
+        // left of it in the market. partially filled orders stay in the book with their new remaining volume
         for (const making_order of trade.making_orders) {
             if (making_order.pcode == this.pcode) {
-                this.update_holdings_available(making_order, true);
+                this.update_holdings_available(making_order, true, making_order.traded_volume);
                 this.update_holdings_trade(making_order.price, making_order.traded_volume, making_order.is_bid, making_order.asset_name);
             }
             if (trade.taking_order.pcode == this.pcode) {
                 this.update_holdings_trade(making_order.price, making_order.traded_volume, trade.taking_order.is_bid, trade.taking_order.asset_name);
             }
-            this._remove_order(making_order)
+            if (making_order.remaining_volume > 0)
+                this._update_order(making_order);
+            else
+                this._remove_order(making_order);
         }
 
         // sorted insert trade into trades list
@@ -201,7 +264,10 @@ export class TraderState extends PolymerElement {
 
     // handle an incoming cancel confirmation message
     _handle_confirm_cancel(event) {
-        const order = event.detail.payload;
+        const order = this._decode_order(event.detail.payload);
+        // orders can already be gone from the book if this message was resent after a snapshot
+        if (!this._check_seq(order.asset_name, order.seq) || this._find_order(order, false) < 0)
+            return;
         this._remove_order(order);
         if (order.pcode == this.pcode) {
             this.update_holdings_available(order, true);
@@ -210,19 +276,204 @@ export class TraderState extends PolymerElement {
         this.dispatchEvent(new CustomEvent('confirm-order-cancel', {detail: order, bubbles: true, composed: true}));
     }
 
-    // removes an order from the bid/ask array
-    _remove_order(order) {
+    // decode an order sent in the compact message format into a regular order object
+    // orders which are already objects are returned as-is
+    _decode_order(encoded) {
+        if (!Array.isArray(encoded))
+            return encoded;
+        const schema = this.compactSchema;
+        const order = {};
+        schema.order_fields.forEach((field, i) => order[field] = encoded[i]);
+        order.timestamp /= 1000;
+        // participant codes and asset names are sent as indices into the schema's lists, unless the backend didn't know them
+        if (typeof order.pcode === 'number')
+            order.pcode = schema.pcodes[order.pcode];
+        if (typeof order.asset_name === 'number')
+            order.asset_name = schema.asset_names[order.asset_name];
+        return order;
+    }
+
+    // decode a trade sent in the compact message format into a regular trade object
+    // trades which are already objects are returned as-is
+    _decode_trade(encoded) {
+        if (!Array.isArray(encoded))
+            return encoded;
+        const [timestamp, asset_name, taking_order, making_orders, seq] = encoded;
+        return {
+            timestamp: timestamp / 1000,
+            asset_name: typeof asset_name === 'number' ? this.compactSchema.asset_names[asset_name] : asset_name,
+            taking_order: this._decode_order(taking_order),
+            making_orders: making_orders.map(o => this._decode_order(o)),
+            seq: seq,
+        };
+    }
+
+    // find the index of an order in the bid/ask array. returns -1 if it isn't there
+    _find_order(order, warn=true) {
         const order_store_name = order.is_bid ? 'bids' : 'asks';
         const order_store = this.get(order_store_name);
-        let i = 0;
-        for (; i < order_store.length; i++)
+        for (let i = 0; i < order_store.length; i++)
             if (order_store[i].order_id == order.order_id)
-                break;
-        if (i >= order_store.length) {
+                return i;
+        if (warn)
             console.warn(`order with id ${order.order_id} not found in ${order_store_name}`);
+        return -1;
+    }
+
+    // open the websocket used to receive messages meant only for this player, like errors
+    // these are sent to this player alone instead of being broadcast to the whole group through redwood
+    _connect_participant_socket() {
+        const protocol = window.location.protocol === 'https:' ? 'wss://' : 'ws://';
+        const addr = `${protocol}${window.location.host}/otree_markets/participant/${this.pcode}/`;
+        const socket = typeof ReconnectingWebSocket === 'undefined'
+            ? new WebSocket(addr)
+            : new ReconnectingWebSocket(addr, null, {timeoutInterval: 10000});
+        const handlers = {
+            error: this._handle_error,
+            resync: this._handle_resync,
+        };
+        // catch up on anything missed since the page was loaded or since the connection was lost
+        socket.onopen = () => this._request_resync(true);
+        socket.onmessage = message => {
+            const msg = JSON.parse(message.data);
+            const handler = handlers[msg.channel];
+            if (!handler) {
+                console.warn(`unknown channel ${msg.channel} in participant message`);
+                return;
+            }
+            handler.call(this, {detail: {payload: msg.payload}});
+        };
+    }
+
+    // check the sequence number of an incoming confirmation for an asset. returns true if the message should be handled,
+    // or false if it's already been handled. if some messages were missed, asks the backend to resend them
+    _check_seq(asset_name, seq) {
+        if (seq === undefined)
+            return true;
+        const last = this._seqs[asset_name] || 0;
+        if (seq <= last)
+            return false;
+        if (seq > last + 1) {
+            // the missed messages are resent along with this one
+            this._request_resync();
+            return false;
+        }
+        this._seqs[asset_name] = seq;
+        return true;
+    }
+
+    // ask the backend to resend every message after the last one handled for each asset
+    // requests are limited to one a second unless force is set. a request made too soon is sent once the second is up
+    _request_resync(force=false) {
+        const now = Date.now();
+        if (!force && this._lastResyncRequest !== null && now - this._lastResyncRequest < 1000) {
+            if (this._pendingResync === null)
+                this._pendingResync = setTimeout(() => this._request_resync(true), this._lastResyncRequest + 1000 - now);
+            return;
+        }
+        if (this._pendingResync !== null) {
+            clearTimeout(this._pendingResync);
+            this._pendingResync = null;
+        }
+        this._lastResyncRequest = now;
+        this.$.resync_chan.send({
+            epoch: this._streamEpoch,
+            seqs: this._seqs,
+        });
+    }
+
+    // handle an incoming resync message. this either has the messages which were missed for an asset,
+    // or a snapshot of that asset's market and this player's holdings if too much was missed
+    _handle_resync(event) {
+        const resync = event.detail.payload;
+        if (!resync.snapshot) {
+            this._handle_batch({detail: {payload: resync.messages}});
+            return;
+        }
+
+        const asset_name = resync.asset_name;
+        const not_this_asset = o => o.asset_name != asset_name;
+        this.set('bids', this.bids.filter(not_this_asset).concat(resync.snapshot.bids));
+        this.set('asks', this.asks.filter(not_this_asset).concat(resync.snapshot.asks));
+        this.set('trades', this.trades.filter(not_this_asset).concat(resync.snapshot.trades));
+        if (resync.snapshot.depth)
+            this.set(['depth', asset_name], resync.snapshot.depth);
+        if (resync.holdings) {
+            this.set('settledAssetsDict', resync.holdings.settled_assets);
+            this.set('availableAssetsDict', resync.holdings.available_assets);
+            this.settledCash = resync.holdings.settled_cash;
+            this.availableCash = resync.holdings.available_cash;
+        }
+        this._seqs[asset_name] = resync.seq;
+
+        // if the backend restarted, messages sent since then were ignored because their sequence numbers looked old.
+        // now that the new stream is known, ask for them again
+        if (resync.epoch != this._streamEpoch) {
+            this._streamEpoch = resync.epoch;
+            this._request_resync(true);
+        }
+    }
+
+    // handle an incoming depth update, which has the new volume of every price level that changed
+    _handle_depth(event) {
+        const update = event.detail.payload;
+        if (!this._check_seq(update.asset_name, update.seq))
             return;
+        const depth = this.depth[update.asset_name] || {bids: [], asks: []};
+        this.set(['depth', update.asset_name], {
+            bids: this._merge_depth_levels(depth.bids, update.bids, true),
+            asks: this._merge_depth_levels(depth.asks, update.asks, false),
+        });
+    }
+
+    // apply changed [price, volume] levels to one side of a depth ladder. levels with volume 0 are removed
+    _merge_depth_levels(levels, changed, is_bid) {
+        const volumes = new Map(levels);
+        for (const [price, volume] of changed) {
+            if (volume > 0)
+                volumes.set(price, volume);
+            else
+                volumes.delete(price);
+        }
+        return Array.from(volumes).sort((a, b) => is_bid ? b[0] - a[0] : a[0] - b[0]);
+    }
+
+    // handle an incoming batch of messages
+    // each message in the batch is handled in order exactly as if it had arrived on its own channel
+    _handle_batch(event) {
+        const handlers = {
+            confirm_enter: this._handle_confirm_enter,
+            confirm_trade: this._handle_confirm_trade,
+            confirm_cancel: this._handle_confirm_cancel,
+            depth: this._handle_depth,
+        };
+        for (const msg of event.detail.payload) {
+            const handler = handlers[msg.channel];
+            if (!handler) {
+                console.warn(`unknown channel ${msg.channel} in batch message`);
+                continue;
+            }
+            handler.call(this, {detail: {payload: msg.payload}});
         }
-        this.splice(order_store_name, i, 1);
+    }
+
+    // removes an order from the bid/ask array
+    _remove_order(order) {
+        const i = this._find_order(order);
+        if (i >= 0)
+            this.splice(order.is_bid ? 'bids' : 'asks', i, 1);
+    }
+
+    // updates the traded and remaining volume of an order in the bid/ask array after it's partially filled
+    _update_order(order) {
+        const i = this._find_order(order);
+        if (i < 0)
+            return;
+        const order_store_name = order.is_bid ? 'bids' : 'asks';
+        const old = this.get([order_store_name, i]);
+        this.splice(order_store_name, i, 1, Object.assign({}, old, {
+            remaining_volume: order.remaining_volume,
+        }));
     }
 
     // handle an incoming error message
@@ -286,12 +537,13 @@ export class TraderState extends PolymerElement {
 
     // update this player's available holdings when an order is inserted/removed
     // removed is true when an order was removed and false when it was added
-    update_holdings_available(order, removed) {
+    // volume is the amount of the order that was inserted/removed, defaulting to its remaining volume
+    update_holdings_available(order, removed, volume=order.remaining_volume) {
         const sign = removed ? 1 : -1;
         if (order.is_bid)
-            this.availableCash += order.price * order.volume * sign;
+            this.availableCash += order.price * volume * sign;
         else
-            this._update_subproperty('availableAssetsDict', order.asset_name, order.volume * sign)
+            this._update_subproperty('availableAssetsDict', order.asset_name, volume * sign)
     }
 
     _update_subproperty(property, subproperty, amount) {
@@ -1,55 +1,260 @@
-from . import pages 
+from . import pages
+from .exchange.base import OrderStatusEnum
+from .exchange.order_book import OrderBook, Depth
+from .dispatch import EventRing
+from .compact import CompactEncoder
+from .output import DefaultJSONMarketOutputGenerator, StreamingJSONMarketOutputGenerator
 from otree.api import Bot, Submission
+from types import SimpleNamespace
+import json
+import io
 
-class PlayerBot(Bot):
 
-    def print_assets(self):
-        for player in self.group.get_players():
-            print(player.participant.code + ':')
-            print(player.assets, player.cash)
+def check_order_book():
+    '''check that the in-memory book keeps price-time priority'''
+    def order(order_id, price, is_bid, timestamp):
+        return SimpleNamespace(id=order_id, price=price, is_bid=is_bid, timestamp=timestamp)
+
+    book = OrderBook([order(1, 10, True, 2), order(2, 11, True, 3), order(3, 10, True, 1), order(4, 12, False, 1)])
+    # an order re-entered with an older timestamp keeps its place in line, and duplicates are ignored
+    book.insert(order(5, 10, True, 0))
+    book.insert(order(1, 10, True, 2))
+    assert [o.id for o in book.bids] == [2, 5, 3, 1]
+    assert [o.id for o in book.asks] == [4]
+    assert book.bids.best().id == 2 and [o.id for o in book.bids.best_level()] == [2]
+
+    book.remove(order(2, 11, True, 3))
+    book.remove(order(2, 11, True, 3))
+    assert [o.id for o in book.bids.best_level()] == [5, 3, 1]
+    assert len(book.bids) == 3
+    book.remove(order(4, 12, False, 1))
+    assert book.asks.best() is None and book.asks.best_level() is None
+
+def check_depth():
+    '''check that depth levels are added up, removed when empty and listed in priority order'''
+    depth = Depth([SimpleNamespace(is_bid=True, price=10, remaining_volume=2), SimpleNamespace(is_bid=False, price=12, remaining_volume=1)])
+    depth.add(True, 9, 3)
+    depth.add(True, 10, 1)
+    depth.add(False, 13, 4)
+    assert depth.bids.levels() == [[10, 3], [9, 3]]
+    assert depth.asks.levels(1) == [[12, 1]]
+    depth.add(True, 10, -3)
+    assert depth.bids.volume(10) == 0 and depth.bids.levels() == [[9, 3]]
+    depth.add(False, 12, -1)
+    assert depth.asks.levels() == [[13, 4]]
+
+def check_event_ring():
+    '''check which messages an EventRing can still resend'''
+    ring = EventRing(3)
+    assert ring.last_seq == 0 and ring.since(0) == []
+    for i in range(5):
+        ring.append({'channel': 'confirm_enter', 'payload': {'i': i}})
+    assert ring.last_seq == 5
+    assert ring.since(5) == []
+    assert [m['payload']['seq'] for m in ring.since(4)] == [5]
+    assert [m['payload']['seq'] for m in ring.since(2)] == [3, 4, 5]
+    # messages 2 and before aren't kept anymore, and sequence numbers from the future can't be caught up from
+    assert ring.since(1) is None
+    assert ring.since(6) is None
+
+def check_compact_encoder():
+    '''check the compact encoding of orders and trades'''
+    encoder = CompactEncoder(['A', 'B'], ['p1', 'p2'])
+    order = {'timestamp': 1.5, 'price': 10, 'volume': 2, 'is_bid': True, 'pcode': 'p2', 'traded_volume': None,
+             'remaining_volume': 2, 'order_id': 7, 'asset_name': 'B'}
+    assert encoder.encode_order(order) == [1500, 10, 2, True, 1, None, 2, 7, 1]
+    # unknown participant codes are sent as-is
+    assert encoder.encode_order(dict(order, pcode='bot', seq=3)) == [1500, 10, 2, True, 'bot', None, 2, 7, 1, 3]
+    trade = {'timestamp': 2, 'asset_name': 'A', 'taking_order': order, 'making_orders': [order], 'seq': 4}
+    encoded = encoder.encode_message({'channel': 'confirm_trade', 'payload': trade})
+    assert encoded['payload'] == [2000, 0, encoder.encode_order(order), [encoder.encode_order(order)], 4]
+    depth = {'channel': 'depth', 'payload': {'asset_name': 'A', 'bids': [[10, 2]], 'asks': [], 'seq': 5}}
+    assert encoder.encode_message(depth) == depth
+    assert encoder.schema()['pcodes'] == ['p1', 'p2']
+
+def sort_json_output(output):
+    '''sort the orders and trades in a JSON export, so exports which only list orders or trades with the same timestamp
+    in a different order can be compared'''
+    for group_data in output:
+        for exchange_data in group_data['exchange_data']:
+            exchange_data['orders'].sort(key=lambda o: o['id'])
+            exchange_data['trades'].sort(key=lambda t: t['taking_order_id'])
+    return output
+
+
+class PlayerBot(Bot):
 
     def play_round(self):
         if self.round_number > self.subsession.config.num_rounds:
             return
 
         if self.player.id_in_group == 1:
-            self.p1_round()
-        else:
-            self.p2_round()
-
-        exchange = self.group.exchanges.get(asset_name='A')
-        print('orders:')
-        print(exchange)
-        print('trades:')
-        print('\n'.join(str(e) for e in exchange._get_trades_qset()))
+            if self.round_number == 1:
+                check_order_book()
+                check_depth()
+                check_event_ring()
+                check_compact_encoder()
+            for memory_order_book in (False, True):
+                self.check_exchange(memory_order_book)
+                self.check_batches(memory_order_book)
+                self.check_market_and_accept(memory_order_book)
+            self.check_json_outputs()
 
         yield Submission(pages.TextInterface, check_html=False)
         yield Submission(pages.Results, check_html=False)
-    
-    def p1_round(self):
-        msg = {
-            'price': 10,
-            'volume': 1,
-            'is_bid': True,
-            'pcode': self.participant.code,
-            'asset_name': 'A',
-        }
-        self.group._handle_enter(msg)
-        msg = {
-            'price': 9,
-            'volume': 1,
-            'is_bid': True,
-            'pcode': self.participant.code,
-            'asset_name': 'A',
-        }
-        self.group._handle_enter(msg)
-    
-    def p2_round(self):
-        msg = {
-            'price': 10,
-            'volume': 2,
-            'is_bid': False,
-            'pcode': self.participant.code,
-            'asset_name': 'A',
-        }
-        self.group._handle_enter(msg)
+
+    def get_holdings(self, player):
+        '''get a player's saved settled cash, available cash, settled assets and available assets'''
+        player = type(player).objects.get(pk=player.pk)
+        return (player.settled_cash, player.available_cash, player.settled_assets['A'], player.available_assets['A'])
+
+    def assert_holdings_changed(self, player, before, changes):
+        after = self.get_holdings(player)
+        expected = tuple(b + c for b, c in zip(before, changes))
+        assert after == expected, f'expected holdings {expected}, got {after}'
+
+    def check_exchange(self, memory_order_book):
+        '''enter, trade and cancel orders directly on the exchange and check the results'''
+        group = self.group
+        group.memory_order_book = memory_order_book
+        exchange = group.get_exchange('A')
+        # start from an empty cache, so the first order below is entered while the book is being loaded
+        exchange._discard_cached_state()
+
+        buyer = self.player
+        seller = next(p for p in group.get_players() if p.pk != buyer.pk)
+        buyer_before = self.get_holdings(buyer)
+        seller_before = self.get_holdings(seller)
+
+        # the seller's ask rests in the book
+        exchange.enter_order(10, 3, False, seller.participant.code)
+        ask = exchange.orders.latest('id')
+        assert ask.status == OrderStatusEnum.ACTIVE
+        assert exchange.get_bbo() == {'bid': None, 'ask': {'price': 10, 'volume': 3, 'order_id': ask.id}}
+
+        # the buyer's bid partially fills the ask and doesn't rest
+        exchange.enter_order(10, 1, True, buyer.participant.code)
+        bid = exchange.orders.latest('id')
+        ask.refresh_from_db()
+        assert bid.status == OrderStatusEnum.TRADED_TAKER
+        assert ask.status == OrderStatusEnum.ACTIVE and ask.traded_volume == 1
+        fills = list(exchange.fills.filter(taking_order=bid))
+        assert [(f.making_order_id, f.price, f.volume) for f in fills] == [(ask.id, 10, 1)]
+        assert exchange.get_bbo() == {'bid': None, 'ask': {'price': 10, 'volume': 2, 'order_id': ask.id}}
+        if memory_order_book:
+            book = exchange._get_memory_book()
+            assert len(book.bids) == 0 and len(book.asks) == 1
+        self.assert_holdings_changed(buyer, buyer_before, (-10, -10, 1, 1))
+        self.assert_holdings_changed(seller, seller_before, (10, 10, -1, -3))
+
+        # a lower bid rests, then is canceled
+        exchange.enter_order(9, 2, True, buyer.participant.code)
+        resting_bid = exchange.orders.latest('id')
+        assert exchange.get_bbo()['bid'] == {'price': 9, 'volume': 2, 'order_id': resting_bid.id}
+        self.assert_holdings_changed(buyer, buyer_before, (-10, -28, 1, 1))
+        exchange.cancel_order(resting_bid.id)
+        resting_bid.refresh_from_db()
+        assert resting_bid.status == OrderStatusEnum.CANCELED
+        assert exchange.get_bbo()['bid'] is None
+        self.assert_holdings_changed(buyer, buyer_before, (-10, -10, 1, 1))
+
+        # canceling the rest of the ask releases the seller's remaining assets
+        exchange.cancel_order(ask.id)
+        ask.refresh_from_db()
+        assert ask.status == OrderStatusEnum.CANCELED and ask.traded_volume == 1
+        assert exchange.get_bbo() == {'bid': None, 'ask': None}
+        assert exchange._get_order_index() == {}
+        self.assert_holdings_changed(seller, seller_before, (10, 10, -1, -1))
+
+    def check_batches(self, memory_order_book):
+        '''enter and cancel batches of orders and check the results'''
+        group = self.group
+        group.memory_order_book = memory_order_book
+        exchange = group.get_exchange('A')
+        exchange._discard_cached_state()
+        player = self.player
+        pcode = player.participant.code
+        before = self.get_holdings(player)
+
+        # count the batch messages sent by the exchange
+        batches = []
+        confirm_batch = group.confirm_batch
+        group.confirm_batch = lambda confirmations: (batches.append(confirmations), confirm_batch(confirmations))
+
+        # the bid trades with the ask entered just before it in the same batch
+        exchange.enter_orders([
+            {'price': 12, 'volume': 2, 'is_bid': False, 'pcode': pcode},
+            {'price': 12, 'volume': 1, 'is_bid': True, 'pcode': pcode},
+            {'price': 8, 'volume': 1, 'is_bid': True, 'pcode': pcode},
+        ])
+        ask, crossing_bid, bid = list(exchange.orders.order_by('-id')[:3])[::-1]
+        assert [c for c, _ in batches[0]] == ['confirm_enter', 'confirm_trade', 'confirm_enter'] and len(batches) == 1
+        assert ask.status == OrderStatusEnum.ACTIVE and ask.traded_volume == 1
+        assert crossing_bid.status == OrderStatusEnum.TRADED_TAKER
+        assert bid.status == OrderStatusEnum.ACTIVE
+        assert exchange.get_bbo() == {'bid': {'price': 8, 'volume': 1, 'order_id': bid.id},
+                                      'ask': {'price': 12, 'volume': 1, 'order_id': ask.id}}
+        # trading with yourself doesn't change your settled holdings. the ask's remaining unit and the 8 bid are reserved
+        self.assert_holdings_changed(player, before, (0, -8, 0, -1))
+
+        exchange.cancel_all(pcode, side='bid')
+        bid.refresh_from_db()
+        ask.refresh_from_db()
+        assert len(batches) == 2 and [c for c, _ in batches[1]] == ['confirm_cancel']
+        assert bid.status == OrderStatusEnum.CANCELED and ask.status == OrderStatusEnum.ACTIVE
+        assert exchange.get_bbo()['bid'] is None
+        self.assert_holdings_changed(player, before, (0, 0, 0, -1))
+
+        exchange.cancel_all(pcode)
+        ask.refresh_from_db()
+        assert ask.status == OrderStatusEnum.CANCELED
+        assert exchange.get_bbo() == {'bid': None, 'ask': None}
+        self.assert_holdings_changed(player, before, (0, 0, 0, 0))
+        del group.confirm_batch
+
+    def check_market_and_accept(self, memory_order_book):
+        '''trade with a market order and an immediate accept and check the results'''
+        group = self.group
+        group.memory_order_book = memory_order_book
+        exchange = group.get_exchange('A')
+        exchange._discard_cached_state()
+        buyer = self.player
+        seller = next(p for p in group.get_players() if p.pk != buyer.pk)
+        buyer_before = self.get_holdings(buyer)
+        seller_before = self.get_holdings(seller)
+
+        exchange.enter_order(11, 2, False, seller.participant.code)
+        ask = exchange.orders.latest('id')
+
+        # the market bid partially fills the ask
+        exchange.enter_market_order(1, True, buyer.participant.code)
+        market_bid = exchange.orders.latest('id')
+        ask.refresh_from_db()
+        assert market_bid.status == OrderStatusEnum.MARKET_TAKER and market_bid.traded_volume == 1
+        assert ask.status == OrderStatusEnum.ACTIVE and ask.traded_volume == 1
+        assert [(f.price, f.volume) for f in exchange.fills.filter(taking_order=market_bid)] == [(11, 1)]
+        assert exchange.get_bbo()['ask'] == {'price': 11, 'volume': 1, 'order_id': ask.id}
+        self.assert_holdings_changed(buyer, buyer_before, (-11, -11, 1, 1))
+        self.assert_holdings_changed(seller, seller_before, (11, 11, -1, -2))
+
+        # accepting the ask takes the rest of it
+        exchange.accept_immediate(ask.id, buyer.participant.code)
+        taking_order = exchange.orders.latest('id')
+        ask.refresh_from_db()
+        assert taking_order.status == OrderStatusEnum.ACCEPTED_TAKER and taking_order.volume == 1
+        assert ask.status == OrderStatusEnum.ACCEPTED_MAKER and ask.traded_volume == 2
+        assert exchange.get_bbo() == {'bid': None, 'ask': None}
+        self.assert_holdings_changed(buyer, buyer_before, (-22, -22, 2, 2))
+        self.assert_holdings_changed(seller, seller_before, (22, 22, -2, -2))
+
+    def check_json_outputs(self):
+        '''check that the streaming JSON export has the same content as the default one'''
+        default_output = io.StringIO()
+        DefaultJSONMarketOutputGenerator(self.session).write_output(default_output)
+        streaming_output = ''.join(StreamingJSONMarketOutputGenerator(self.session).iter_output())
+        default_data = sort_json_output(json.loads(default_output.getvalue()))
+        streaming_data = sort_json_output(json.loads(streaming_output))
+        assert streaming_data == default_data
+        # make sure the comparison covered trades with several kinds of fills
+        trades = [t for g in streaming_data for e in g['exchange_data'] for t in e['trades']]
+        assert trades and all(len(t['fills']) == len(t['making_order_ids']) for t in trades)
@@ -2,90 +2,129 @@ from otree.models import Session
 from otree.session import SESSION_CONFIGS_DICT
 from otree.common import get_models_module
 from django.template.response import TemplateResponse
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse, FileResponse, Http404
 from django.shortcuts import get_object_or_404
+from django.core.paginator import Paginator
+from django.db.models import F
 from django.urls import path
+from collections.abc import Sequence
+import functools
+import threading
+import os
 import vanilla
-from importlib import import_module
 
 from .models import Group as MarketGroup
-from .output import DefaultJSONMarketOutputGenerator
+from .output import get_output_generators
+from .export_cache import get_cache_path, get_export_path, iter_and_cache_output
+from .session_index import MarketSessionIndex
 
-def make_export_path(config_name, output_generator_class):
-    class MarketOutputExportView(vanilla.View):
+@functools.lru_cache(maxsize=None)
+def _get_output_generators(config_name):
+    '''get a dict mapping class names to output generator classes for a session config, importing apps' output.py files
+    the first time each config is used'''
+    return {g.__name__: g for g in get_output_generators(SESSION_CONFIGS_DICT[config_name])}
 
-        def get(self, request, *args, **kwargs):
-            session = get_object_or_404(Session, code=kwargs['session_code'])
-            output_generator = output_generator_class(session)
 
+class MarketOutputExportView(vanilla.View):
+    '''this view downloads the output of any output generator for any session. the config and output generator are looked
+    up from the url the first time they're used'''
+
+    url_pattern = 'markets_export/<str:config_name>/<str:generator_name>/<str:session_code>/'
+    url_name = 'markets_export'
+
+    def get(self, request, config_name, generator_name, session_code):
+        if config_name not in SESSION_CONFIGS_DICT:
+            raise Http404(f'no session config named "{config_name}"')
+        output_generator_class = _get_output_generators(config_name).get(generator_name)
+        if output_generator_class is None:
+            raise Http404(f'no output generator named "{generator_name}"')
+        session = get_object_or_404(Session, code=session_code)
+        output_generator = output_generator_class(session)
+
+        cache_path = get_cache_path(output_generator) if output_generator.cache_output else None
+        if cache_path and (os.path.exists(cache_path) or not output_generator.streaming):
+            response = FileResponse(open(get_export_path(output_generator, cache_path), 'rb'), content_type=output_generator.get_mime_type())
+        elif cache_path:
+            # if it isn't cached yet, stream it while it's saved instead of making the download wait for the whole file
+            response = StreamingHttpResponse(iter_and_cache_output(output_generator, cache_path), content_type=output_generator.get_mime_type())
+        elif output_generator.streaming:
+            response = StreamingHttpResponse(output_generator.iter_output(), content_type=output_generator.get_mime_type())
+        else:
             response = HttpResponse(content_type=output_generator.get_mime_type())
-            filename = output_generator.get_filename()
-            response['Content-Disposition'] = f'attachment; filename="{filename}"'
             output_generator.write_output(response)
+        filename = output_generator.get_filename()
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+
+        return response
+
+
+class _LazySequence(Sequence):
+    '''a sequence whose items are built by calling `build` the first time they're used'''
+
+    def __init__(self, build):
+        self._build = build
+        self._items = None
+        self._lock = threading.Lock()
 
-            return response
-    
-    url_pattern = f'markets_export/{config_name}/{output_generator_class.__name__}/<str:session_code>/'
-    url_name = f'markets_export_{config_name}_{output_generator_class.__name__}'
-    return path(url_pattern, MarketOutputExportView.as_view(), name=url_name)
+    def _get_items(self):
+        with self._lock:
+            if self._items is None:
+                self._items = list(self._build())
+            return self._items
 
-def make_sessions_view(session_config, output_generators):
+    def __getitem__(self, i):
+        return self._get_items()[i]
+
+    def __len__(self):
+        return len(self._get_items())
+
+
+def make_sessions_view(session_config):
     class MarketOutputSessionsView(vanilla.View):
         url_name = f'markets_sessions_{session_config["name"]}'
         url_pattern = f'^{url_name}/$'
         display_name = f'{session_config["display_name"]} Trading Output'
 
-        def get(request, *args, **kwargs):
-            # this is pretty bad ..
-            # we can't just filter on session config since changing any params means that the session's config
-            # will be different from the config in SESSION_CONFIGS_DICT. what we want to do is filter on config['name']
-            # but we can't do that because Session.config is that weird PickleField thing which is stored as base64 text in the DB.
-            #
-            # the only option I came up with is to load EVERY session into memory and filter by config['name'] in python. the values_list
-            # thing is to avoid loading all of every session, this way we just get the config and id for every session, then we can
-            # go back and query again for the full session objects we want. this is probably real slow and will not scale well.
-            # if someone smarter than me and better at database is reading this, please fix this.
-            session_ids = (
-                session_id
-                for config, session_id
-                in Session.objects.values_list('config', 'id')
-                if config['name'] == session_config['name']
-            )
-            sessions = Session.objects.filter(id__in=session_ids)
+        sessions_per_page = 50
+
+        def get(self, request, *args, **kwargs):
+            # we can't filter on Session.config directly since it's a pickled field, so sessions are looked up by config name
+            # in MarketSessionIndex instead. sessions created before the index existed are added with the index_market_sessions command
+            session_ids = (MarketSessionIndex.objects.filter(config_name=session_config['name'])
+                                                     .order_by(F('created').desc(nulls_last=True), '-session_id')
+                                                     .values_list('session_id', flat=True))
+            page = Paginator(session_ids, self.sessions_per_page).get_page(request.GET.get('page'))
+            sessions_by_id = Session.objects.in_bulk(list(page))
             context = {
                 'session_config': session_config,
-                'sessions': sessions,
+                'sessions': [sessions_by_id[session_id] for session_id in page if session_id in sessions_by_id],
+                'page': page,
                 'output_types': [
                     {
-                        'url_name': f'markets_export_{session_config["name"]}_{generator_class.__name__}',
+                        'config_name': session_config['name'],
+                        'generator_name': generator_name,
                         'link_text': generator_class.download_link_text,
                     }
-                    for generator_class in output_generators
+                    for generator_name, generator_class in _get_output_generators(session_config['name']).items()
                 ]
             }
             return TemplateResponse(request, 'otree_markets/MarketOutputSessionsView.html', context)
 
     return MarketOutputSessionsView
 
-markets_export_views = []
-markets_export_urls = []
-for session_config in SESSION_CONFIGS_DICT.values():
-    # if there aren't any markets apps in the app sequence, don't make an output page for them
-    if not any(issubclass(get_models_module(app_name).Group, MarketGroup) for app_name in session_config['app_sequence']):
-        continue
-
-    # output_generators is a list of subclasses of output.BaseMarketOutputGenerator
-    # if no output generators are provided by an app, just include the default json generator
-    output_generators = []
-    for app_name in session_config['app_sequence']:
-        try:
-            output_module = import_module(f'{app_name}.output')
-            output_generators.extend(output_module.output_generators)
-        except (ImportError, AttributeError):
-            continue
-    if not output_generators:
-        output_generators.append(DefaultJSONMarketOutputGenerator)
-
-    markets_export_views.append(make_sessions_view(session_config, output_generators))
-    for output_generator in output_generators:
-        markets_export_urls.append(make_export_path(session_config['name'], output_generator))
+def _make_export_views():
+    '''make a sessions view for every session config with a markets app in its app sequence'''
+    for session_config in SESSION_CONFIGS_DICT.values():
+        # if there aren't any markets apps in the app sequence, don't make an output page for them.
+        # apps' models modules have already been imported by django at this point, so this doesn't import anything new
+        if any(issubclass(get_models_module(app_name).Group, MarketGroup) for app_name in session_config['app_sequence']):
+            yield make_sessions_view(session_config)
+
+markets_export_views = _LazySequence(_make_export_views)
+'''the sessions views for each session config with a markets app, made the first time oTree reads them'''
+
+# every download goes through MarketOutputExportView's single route, so this doesn't need to know about any
+# session configs or output generators. apps' output.py files are only imported when their config is first used
+markets_export_urls = [
+    path(MarketOutputExportView.url_pattern, MarketOutputExportView.as_view(), name=MarketOutputExportView.url_name),
+]